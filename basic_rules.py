@@ -3,7 +3,7 @@ from typing import List, Tuple, Optional
 import subprocess, tempfile
 from objects import *
 
-def read_rules(fname):
+def read_rules(fname, grammar: Grammar):
     f = open(fname)
     rules = f.read().splitlines()
     f.close()
@@ -13,14 +13,14 @@ def read_rules(fname):
         rl = r.split()
         pos_tags.add(l)
         pos_tags.update(rl)
-        Rule(l, rl)
+        grammar.add_rule(Rule(l, rl))
     for tag in pos_tags:
-        Pattern(tag)
+        grammar.add_pattern(tag)
 
 def align_corpus(sens):
     for i, sn in enumerate(sens.sens):
         print('---------------------')
-        al = sn.sl.align_tree_to_flat(sn.tl.children)
+        al = sn.sl.align_tree_to_flat(sn.tl.children, sn.beam)
         sn.sl.filter_align(al)
         sn.sl.suggest_rules([i], sn.tl.children)
         print(al)
@@ -33,9 +33,10 @@ if __name__ == '__main__':
     parser.add_argument('cfg_rules', help='new-line separated CFG rules, such as generated by rtx-comp -s')
     parser.add_argument('rtx_file', help='file to write generated rules to')
     args = parser.parse_args()
-    read_rules(args.cfg_rules)
-    generate_rule_file(args.rtx_file)
-    sens = corpus.get_corpus(args)
+    grammar = Grammar()
+    read_rules(args.cfg_rules, grammar)
+    generate_rule_file(args.rtx_file, grammar)
+    sens = corpus.get_corpus(args, grammar)
     for sen in sens.sens:
         print(sen.sl)
     print('+++++++++++++++++++++++++++++')
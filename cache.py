@@ -0,0 +1,7 @@
+#!/usr/bin/env python3
+
+import os
+
+# where eflomal output, analyses, etc. are saved between runs
+CACHE_DIR = os.environ.get('RTXLEARN_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'apertium-recursive-learning'))
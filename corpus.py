@@ -2,9 +2,16 @@
 
 import argparse
 import os
+import sys
 import subprocess
-import math
+import hashlib
+import sqlite3
+import shutil
+import re
 from tempfile import NamedTemporaryFile
+from typing import List, Tuple, Optional
+from vocab import Vocab
+from cache import CACHE_DIR
 from objects import *
 
 def make_corpus_argparse(description):
@@ -20,12 +27,16 @@ def make_corpus_argparse(description):
     parser.add_argument('-sep', '--separator', help='divider between source and target sentences if using a bilingual corpus (default |||)', default='|||')
     parser.add_argument('-a', '--aligner', help='what program to use for word-alignment', choices=['eflomal', 'biltrans'], default='eflomal')
     #parser.add_argument('-b', '--biltrans-suggestions', help='file to write possible bilingual dictionary entries to')
+    parser.add_argument('-j', '--jobs', help='number of processes to use for analysis and for rtx-proc (default 1)', type=int, default=1)
+    parser.add_argument('-nc', '--no-cache', help="don't reuse or save analyses of previously seen sentences", action='store_true')
     parser.add_argument('-f', '--full-tags', action='append', help='align a part of speech based on full analysis rather than just lemma and first tag, e.g. -f prn')
+    parser.add_argument('--beam', help='when aligning trees with the target sentence, keep at most this many partial alignments of the children of each node (default 0, no limit)', type=int, default=0)
+    # apertium's -f; the analyses are parsed as they are, without deformatting
+    parser.set_defaults(format='none')
     return parser
 
-def tokenize(an_file, tok_file, full_tags):
-    tok_to_id = {}
-    id_to_tok = []
+def tokenize(an_file, tok_file, full_tags, vocab: Vocab):
+    '''write the words of an_file to tok_file as eflomal ids from vocab'''
     sents = []
     an_file.seek(0)
     import numpy
@@ -37,11 +48,7 @@ def tokenize(an_file, tok_file, full_tags):
             an = word.split('^')[-1].split('/')[0]
             if '<' in an and an.split('<')[1][:-1] not in full_tags:
                 an = word.split('>')[0] + '>'
-            tid = tok_to_id.get(an, -1)
-            if tid == -1:
-                tok_to_id[an] = len(id_to_tok)
-                id_to_tok.append(an)
-            cur.append(tid)
+            cur.append(vocab.intern(an))
         sents.append(numpy.asarray(cur, dtype=numpy.uint32))
     #tok_file.write('%d %d\n' % (len(sents), len(id_to_tok)))
     #for sn in sents:
@@ -50,28 +57,20 @@ def tokenize(an_file, tok_file, full_tags):
     #    else:
     #        tok_file.write(' '.join(str(n) for n in sn) + '\n')
     import eflomal
-    eflomal.write_text(tok_file, tuple(sents), len(id_to_tok))
+    eflomal.write_text(tok_file, tuple(sents), len(vocab))
     return len(sents)
 
-def eflomal_ize(sl_file, tl_file, full_tags):
+def eflomal_ize(sl_file, tl_file, full_tags, sl_vocab: Vocab, tl_vocab: Vocab):
     sl_nums = NamedTemporaryFile('wb+')
     tl_nums = NamedTemporaryFile('wb+')
-    n = tokenize(sl_file, sl_nums, full_tags)
-    tokenize(tl_file, tl_nums, full_tags)
-    align = NamedTemporaryFile('w+')
-
-    # I don't know what this is calculating, but it corresponds to the
-    # default arguments in the eflomal python interface
-    defaults = ['-m', '3', '-n', '1', '-N', '0.2']
-    iters = max(2, int(round(5000.0 / math.sqrt(n))))
-    iters4 = max(1, iters//4)
-    defaults += ['-1', str(max(2, iters4)), '-2', str(iters4), '-3', str(iters)]
-
-    subprocess.run(['eflomal', '-s', sl_nums.name, '-t', tl_nums.name,
-                    '-f', align.name, '-q'] + defaults)
-    align.seek(0)
+    n = tokenize(sl_file, sl_nums, full_tags, sl_vocab)
+    tokenize(tl_file, tl_nums, full_tags, tl_vocab)
+    sl_nums.flush()
+    tl_nums.flush()
+
+    from eflomal_wrapper import align_files
     ret = []
-    for line in align:
+    for line in align_files(sl_nums.name, tl_nums.name, n).splitlines():
         dct = {}
         for nums in line.split():
             sl, tl = nums.split('-')
@@ -108,9 +107,13 @@ def biltrans_align(sl, tl):
                 ret[i] = [x[0] for x in possible]
     return ret
 
-def analyze(args, side, infilename, outfilename):
+def analysis_command(args, side) -> Tuple[List[str], bool]:
+    '''the apertium command to analyze one side of the corpus with,
+    and whether its output needs to go through apertium-pretransfer'''
     using_mono = (not args.pair_path and (args.source_path or args.target_path))
-    cmd = ['apertium', '-f', 'none']
+    cmd = ['apertium']
+    if args.format:
+        cmd += ['-f', args.format]
     if args.pair_path:
         cmd += ['-d', args.pair_path]
     elif using_mono and side == 'source' and args.source_path:
@@ -124,18 +127,127 @@ def analyze(args, side, infilename, outfilename):
             lang += '-biltrans'
         else:
             lang += '-pretransfer'
-        subprocess.run(cmd + [lang, infilename, outfilename])
+        return (cmd + [lang], False)
     else:
         lang += '-tagger'
         # TODO: what happens if someone does --aligner=biltrans with monolinguals?
-        tmp = NamedTemporaryFile('w+')
-        tmp.seek(0)
-        subprocess.run(cmd + [lang, infilename, tmp.name])
-        subprocess.run(['apertium-pretransfer', tmp.name, outfilename])
-
-def get_corpus(args):
-    sl_text = NamedTemporaryFile('w+')
-    tl_text = NamedTemporaryFile('w+')
+        return (cmd + [lang], True)
+
+def analyze(args, side, infilename, outfile) -> List[subprocess.Popen]:
+    '''start analyzing infilename into the open file outfile
+    returns the processes, which the caller must wait for'''
+    cmd, mono = analysis_command(args, side)
+    if not mono:
+        return [subprocess.Popen(cmd + [infilename], stdout=outfile)]
+    else:
+        tagger = subprocess.Popen(cmd + [infilename], stdout=subprocess.PIPE)
+        pretransfer = subprocess.Popen(['apertium-pretransfer'], stdin=tagger.stdout, stdout=outfile)
+        # so that the tagger gets SIGPIPE if pretransfer dies
+        tagger.stdout.close()
+        return [tagger, pretransfer]
+
+def mode_files(cmd: List[str]) -> List[str]:
+    '''the mode file that the apertium command cmd runs, then the files it reads
+    or [] if the mode file can't be found'''
+    if '-d' in cmd:
+        path = cmd[cmd.index('-d')+1]
+    else:
+        # without -d, apertium looks in the data directory of its own prefix
+        exe = shutil.which('apertium')
+        if not exe:
+            return []
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(exe))), 'share', 'apertium')
+    for mode in [os.path.join(path, 'modes', cmd[-1] + '.mode'), os.path.join(path, cmd[-1] + '.mode')]:
+        if os.path.isfile(mode):
+            break
+    else:
+        return []
+    with open(mode) as f:
+        words = re.split(r'[\s\'"|]+', f.read())
+    return [mode] + sorted(set(w for w in words if os.path.isabs(w) and os.path.isfile(w)))
+
+class AnalysisCache:
+    '''analyses of single lines, saved in an sqlite database in CACHE_DIR
+    and keyed by the analysis command and the line
+    the key includes the sizes and modification times of the mode file and
+    the compiled files it uses, so recompiling or reinstalling invalidates the cache'''
+    def __init__(self, cmd: List[str], mono: bool, files: List[str]):
+        h = hashlib.sha256(repr((cmd, mono)).encode('utf-8'))
+        for f in files:
+            st = os.stat(f)
+            h.update(('%s %s %s\n' % (f, st.st_size, st.st_mtime_ns)).encode('utf-8'))
+        self.prefix = h.hexdigest()
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(CACHE_DIR, 'analyses.sqlite'))
+        self.db.execute('CREATE TABLE IF NOT EXISTS analyses (key TEXT PRIMARY KEY, analysis TEXT)')
+    def key(self, line: str) -> str:
+        return hashlib.sha256((self.prefix + '\n' + line).encode('utf-8')).hexdigest()
+    def get(self, lines: List[str]) -> List[Optional[str]]:
+        '''the cached analysis of each line, or None'''
+        found = {}
+        keys = [self.key(l) for l in lines]
+        # sqlite limits the number of parameters in one query
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            query = 'SELECT key, analysis FROM analyses WHERE key IN (%s)' % ','.join('?' * len(chunk))
+            found.update(self.db.execute(query, chunk))
+        return [found.get(k) for k in keys]
+    def put(self, lines: List[str], analyses: List[str]):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO analyses VALUES (?, ?)',
+                                [(self.key(l), a) for l, a in zip(lines, analyses)])
+
+def get_analysis_cache(args, side) -> Optional[AnalysisCache]:
+    '''the AnalysisCache for one side of the corpus, or None if we can't
+    find the mode file, since then there's no telling when it changes'''
+    cmd, mono = analysis_command(args, side)
+    files = mode_files(cmd)
+    if not files:
+        return None
+    return AnalysisCache(cmd, mono, files)
+
+def analyze_sides(args, sides: List[Tuple[str, List[str]]]) -> List[List[str]]:
+    '''analyze the lines of each side at once, each split into args.jobs
+    pieces, and return the analysis of each line
+    unless args.no_cache is set, only lines not in the AnalysisCache are analyzed'''
+    procs = []
+    chunks = []
+    ret = []
+    for side, lines in sides:
+        # the extra . flushes the tagger
+        lines = lines + ['.']
+        cache = None if args.no_cache else get_analysis_cache(args, side)
+        found = cache.get(lines) if cache else [None] * len(lines)
+        todo = [i for i, a in enumerate(found) if a is None]
+        size = max(1, -(-len(todo) // max(1, args.jobs)))
+        for i in range(0, len(todo), size):
+            idx = todo[i:i+size]
+            text = NamedTemporaryFile('w+')
+            # each piece needs its own . so that its last line gets flushed
+            text.write(''.join(lines[j] + '\n' for j in idx) + '.\n')
+            text.flush()
+            out = NamedTemporaryFile('w+')
+            procs += analyze(args, side, text.name, out)
+            chunks.append((lines, found, cache, idx, text, out))
+        ret.append(found)
+    for proc in procs:
+        proc.wait()
+    for lines, found, cache, idx, text, out in chunks:
+        out.seek(0)
+        result = out.read().splitlines()
+        if len(result) != len(idx) + 1:
+            raise Exception('Analyzing %s lines gave %s lines of output' % (len(idx) + 1, len(result)))
+        for j, a in zip(idx, result):
+            found[j] = a
+        if cache:
+            cache.put([lines[j] for j in idx], result[:-1])
+        text.close()
+        out.close()
+    return ret
+
+def get_corpus(args, grammar: Optional[Grammar] = None):
+    sl_text = []
+    tl_text = []
     sl_an = NamedTemporaryFile('w+')
     tl_an = NamedTemporaryFile('w+')
     if args.corpus:
@@ -152,8 +264,8 @@ def get_corpus(args):
                 if not sl or not tl:
                     # TODO: WARNING - skipping line i+1
                     continue
-                sl_text.write(sl + '\n')
-                tl_text.write(tl + '\n')
+                sl_text.append(sl)
+                tl_text.append(tl)
     elif args.sl_corpus and args.tl_corpus:
         sl_lines = []
         tl_lines = []
@@ -170,20 +282,19 @@ def get_corpus(args):
             if not sl or not tl:
                 # TODO: WARNING - skipping line i+1
                 continue
-            sl_text.write(sl + '\n')
-            tl_text.write(tl + '\n')
+            sl_text.append(sl)
+            tl_text.append(tl)
     else:
         # TODO: ERROR - must supply sl&tl or bitext
         return
-    sl_text.write('.\n')
-    tl_text.write('.\n')
-    sl_text.seek(0)
-    tl_text.seek(0)
 
     # TODO: suggest bidix entries
 
-    analyze(args, 'source', sl_text.name, sl_an.name)
-    analyze(args, 'target', tl_text.name, tl_an.name)
+    sl_res, tl_res = analyze_sides(args, [('source', sl_text), ('target', tl_text)])
+    sl_an.write(''.join(l + '\n' for l in sl_res))
+    tl_an.write(''.join(l + '\n' for l in tl_res))
+    sl_an.flush()
+    tl_an.flush()
 
     tl_lus = parse_file(tl_an, side='tl')
     if args.aligner == 'biltrans':
@@ -195,7 +306,7 @@ def get_corpus(args):
         for s, t in zip(sl_lus, tl_lus):
             align.append(biltrans_align(s, t))
     elif args.aligner == 'eflomal':
-        align = eflomal_ize(sl_an, tl_an, args.full_tags or [])
+        align = eflomal_ize(sl_an, tl_an, args.full_tags or [], Vocab(), Vocab())
         for tree, flat, alg in zip(sl_lus, tl_lus, align):
             tree.assign_alignment(alg)
             for i, w in enumerate(flat.children):
@@ -205,5 +316,24 @@ def get_corpus(args):
         align = [None]*len(sl_lus)
     sens = []
     for sl, tl, alg in zip(sl_lus, tl_lus, align):
-        sens.append(Sentence(sl, tl, alg))
-    return Corpus(sens)
+        sens.append(Sentence(sl, tl, alg, args.beam))
+    return Corpus(sens, args.jobs, grammar)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='analyze stdin with a monolingual tagger and apertium-pretransfer, reusing cached analyses of previously seen lines')
+    parser.add_argument('lang', help='language to analyze')
+    parser.add_argument('path', help='path to directory of analyzer')
+    parser.add_argument('-j', '--jobs', help='number of pieces to split the input into, all of which are analyzed at once (default 1)', type=int, default=1)
+    parser.add_argument('-nc', '--no-cache', help="don't reuse or save analyses of previously seen lines", action='store_true')
+    parser.add_argument('-f', '--format', help="apertium's format option (default: apertium's own default, txt)")
+    args = parser.parse_args()
+    args.pair_path = None
+    args.source_path = args.path
+    args.target_path = None
+    args.src_lang = args.lang
+    args.trg_lang = args.lang
+    args.aligner = 'eflomal'
+    lines = [l.rstrip('\n') for l in sys.stdin]
+    res = analyze_sides(args, [('source', lines)])[0]
+    # leave out the analysis of the extra .
+    sys.stdout.write(''.join(l + '\n' for l in res[:-1]))
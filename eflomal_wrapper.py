@@ -2,50 +2,214 @@
 
 import numpy
 import eflomal
-from tempfile import NamedTemporaryFile
+from tempfile import TemporaryDirectory
 import subprocess
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Optional, Sequence
 import math
-from collections import defaultdict
-
-def run_eflomal(sents: List[Tuple[List[int], List[int]]]) -> List[Dict[int, int]]:
-    sl_nums = NamedTemporaryFile('wb+')
-    sl = tuple([numpy.asarray(x[0], dtype=numpy.uint32) for x in sents])
-    eflomal.write_text(sl_nums, sl, 1+max(map(lambda x: max(x[0]), sents)))
-    tl_nums = NamedTemporaryFile('wb+')
-    tl = tuple([numpy.asarray(x[1], dtype=numpy.uint32) for x in sents])
-    eflomal.write_text(tl_nums, tl, 1+max(map(lambda x: max(x[1]), sents)))
+import os
+import hashlib
+from collections import Counter
+from cache import CACHE_DIR
 
+def eflomal_args(n: int) -> List[str]:
     # I don't know what this is calculating, but it corresponds to the
     # default arguments in the eflomal python interface
     defaults = ['-m', '3', '-n', '1', '-N', '0.2']
-    iters = max(2, int(round(5000.0 / math.sqrt(len(sents)))))
+    iters = max(2, int(round(5000.0 / math.sqrt(n))))
     iters4 = max(1, iters//4)
     defaults += ['-1', str(max(2, iters4)), '-2', str(iters4), '-3', str(iters)]
+    return defaults
+
+def cache_key(fnames: List[str], args: List[str]) -> str:
+    h = hashlib.sha256()
+    for fname in fnames:
+        h.update(str(os.path.getsize(fname)).encode('ascii') + b'\n')
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    h.update(' '.join(args).encode('utf-8'))
+    return h.hexdigest()
+
+def align_files(sl_fname: str, tl_fname: str, n: int, cache: bool = True,
+                priors: Optional[str] = None) -> str:
+    '''run eflomal on files of token ids written by eflomal.write_text
+    and return its output
+    priors is an optional file in the format written by index_priors()
+    if cache is set and eflomal has been run on identical files before,
+    the saved output of that run is returned instead'''
+    args = eflomal_args(n)
+    fnames = [sl_fname, tl_fname] + ([priors] if priors else [])
+    path = None
+    if cache:
+        path = os.path.join(CACHE_DIR, 'eflomal', cache_key(fnames, args) + '.txt')
+        if os.path.exists(path):
+            with open(path) as f:
+                return f.read()
+    if priors:
+        args = args + ['-p', priors]
+    with TemporaryDirectory() as tmp:
+        align = os.path.join(tmp, 'align.txt')
+        proc = subprocess.run(['eflomal', '-s', sl_fname, '-t', tl_fname,
+                               '-f', align, '-q'] + args)
+        txt = ''
+        if os.path.exists(align):
+            with open(align) as f:
+                txt = f.read()
+    if path and proc.returncode == 0:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename so a concurrent run never reads half a file
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(txt)
+        os.replace(tmp, path)
+    return txt
+
+class Alignments:
+    '''word alignments of a whole corpus as flat arrays
+    the links of sentence i are from sl[offsets[i]:offsets[i+1]]
+    to the corresponding elements of tl'''
+    def __init__(self, offsets: numpy.ndarray, sl: numpy.ndarray, tl: numpy.ndarray):
+        self.offsets = offsets
+        self.sl = sl
+        self.tl = tl
+    def fromtext(txt: str) -> "Alignments":
+        '''parse eflomal output (one line of sl-tl pairs per sentence)'''
+        lines = txt.splitlines()
+        offsets = numpy.zeros(len(lines) + 1, dtype=numpy.int64)
+        numpy.cumsum([l.count('-') for l in lines], out=offsets[1:])
+        nums = numpy.fromstring(txt.replace('-', ' '), dtype=numpy.int32, sep=' ')
+        return Alignments(offsets, nums[0::2], nums[1::2])
+    def fromfile(fname: str) -> "Alignments":
+        with open(fname) as f:
+            return Alignments.fromtext(f.read())
+    def __len__(self):
+        return len(self.offsets) - 1
+    def __getitem__(self, i: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        a, b = self.offsets[i], self.offsets[i+1]
+        return (self.sl[a:b], self.tl[a:b])
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def run_eflomal(sents: List[Tuple[List[int], List[int]]], priors: Optional[str] = None) -> Alignments:
+    '''priors is the text of a file written by index_priors()'''
+    # a private directory, so that simultaneous runs can't see each other's files
+    with TemporaryDirectory() as tmp:
+        sl_nums = os.path.join(tmp, 'sl.bin')
+        with open(sl_nums, 'wb') as f:
+            sl = tuple([numpy.asarray(x[0], dtype=numpy.uint32) for x in sents])
+            eflomal.write_text(f, sl, 1+max(map(lambda x: max(x[0]), sents)))
+        tl_nums = os.path.join(tmp, 'tl.bin')
+        with open(tl_nums, 'wb') as f:
+            tl = tuple([numpy.asarray(x[1], dtype=numpy.uint32) for x in sents])
+            eflomal.write_text(f, tl, 1+max(map(lambda x: max(x[1]), sents)))
+        priors_fname = None
+        if priors is not None:
+            priors_fname = os.path.join(tmp, 'priors.txt')
+            with open(priors_fname, 'w') as f:
+                f.write(priors)
+        return Alignments.fromtext(align_files(sl_nums, tl_nums, len(sents),
+                                               priors=priors_fname))
+
+def postedit_eflomal(fname) -> Alignments:
+    return Alignments.fromfile(fname)
+
+# the kinds of priors eflomal takes: (source, target) word pairs,
+# forward and reverse jump lengths, and source and target word fertilities
+PRIOR_KINDS = ['LEX', 'HMMF', 'HMMR', 'FERF', 'FERR']
+
+def count_priors(priors: Dict[str, Counter], sl_words: List[str], tl_words: List[str],
+                 sl: Sequence[int], tl: Sequence[int]):
+    '''add the counts from one aligned sentence pair to priors'''
+    fwd: Dict[int, int] = {}
+    rev: Dict[int, int] = {}
+    for i, j in zip(sl, tl):
+        priors['LEX'][(sl_words[i], tl_words[j])] += 1
+        fwd.setdefault(j, i)
+        rev.setdefault(i, j)
+    for kind, links in [('HMMF', fwd), ('HMMR', rev)]:
+        prev = -1
+        for k in sorted(links):
+            priors[kind][(links[k] - prev,)] += 1
+            prev = links[k]
+    for kind, words, ls in [('FERF', sl_words, sl), ('FERR', tl_words, tl)]:
+        fert = Counter(ls)
+        for i, w in enumerate(words):
+            priors[kind][(w, fert[i])] += 1
+
+def read_priors(fname: str) -> Dict[str, Counter]:
+    '''read a file of tab-separated KIND, key..., count lines
+    (the same format as eflomal's makepriors)'''
+    priors = {k: Counter() for k in PRIOR_KINDS}
+    if os.path.exists(fname):
+        with open(fname) as f:
+            for line in f:
+                ls = line.rstrip('\n').split('\t')
+                if ls[0] == 'LEX':
+                    key = (ls[1], ls[2])
+                elif ls[0] in ['HMMF', 'HMMR']:
+                    key = (int(ls[1]),)
+                else:
+                    key = (ls[1], int(ls[2]))
+                priors[ls[0]][key] += float(ls[-1])
+    return priors
+
+def write_priors(fname: str, priors: Dict[str, Counter]):
+    with open(fname, 'w') as f:
+        for kind in PRIOR_KINDS:
+            for key, n in sorted(priors[kind].items()):
+                f.write('\t'.join([kind] + [str(k) for k in key] + ['%g' % n]) + '\n')
 
-    #align = NamedTemporaryFile('w+')
-    align = open('jam-alignments.txt', 'w+')
-    subprocess.run(['eflomal', '-s', sl_nums.name, '-t', tl_nums.name,
-                    '-f', align.name, '-q'] + defaults)
-    align.seek(0)
-    ret = []
-    for line in align:
-        dct = {}
-        for nums in line.split():
-            sl, tl = nums.split('-')
-            dct[int(sl)] = int(tl)
-        ret.append(dct)
-    align.close()
-    return ret
-
-def postedit_eflomal(fname):
-    with open(fname) as f:
-        ret = []
-        for line in f.read().splitlines():
-            dct = defaultdict(list)
-            for nums in line.split():
-                sl, tl = nums.split('-')
-                dct[int(sl)].append(int(tl))
-            ret.append(dct)
-        return ret
+def index_priors(priors: Dict[str, Counter], sl_ids: Dict[str, int], tl_ids: Dict[str, int]) -> str:
+    '''priors in the format the eflomal binary reads with -p,
+    leaving out words that aren't in sl_ids or tl_ids'''
+    lex = [(sl_ids[s], tl_ids[t], n) for (s, t), n in priors['LEX'].items()
+           if s in sl_ids and t in tl_ids]
+    hmmf = [(j, n) for (j,), n in priors['HMMF'].items()]
+    hmmr = [(j, n) for (j,), n in priors['HMMR'].items()]
+    ferf = [(sl_ids[w], k, n) for (w, k), n in priors['FERF'].items() if w in sl_ids]
+    ferr = [(tl_ids[w], k, n) for (w, k), n in priors['FERR'].items() if w in tl_ids]
+    lines = ['%d %d %d %d %d' % (len(lex), len(hmmf), len(hmmr), len(ferf), len(ferr))]
+    for ls in [lex, hmmf, hmmr, ferf, ferr]:
+        for entry in sorted(ls):
+            lines.append(' '.join(map(str, entry[:-1])) + ' %g' % entry[-1])
+    return '\n'.join(lines) + '\n'
 
+def align_incremental(sents: List[Tuple[List[str], List[str]]], store: str) -> Alignments:
+    '''word align sentence pairs, reusing the alignments saved in the
+    directory store by previous calls and aligning only the pairs not found
+    there, using the priors counted from everything aligned so far
+    the new alignments and updated priors are then saved in store'''
+    links_fname = os.path.join(store, 'links.txt')
+    priors_fname = os.path.join(store, 'priors.txt')
+    links: Dict[str, str] = {}
+    if os.path.exists(links_fname):
+        with open(links_fname) as f:
+            for line in f:
+                k, v = line.rstrip('\n').split('\t')
+                links[k] = v
+    # lemmas can contain spaces, so separate words with newlines
+    keys = [hashlib.sha1(('\n'.join(sl) + '\n\n' + '\n'.join(tl)).encode('utf-8')).hexdigest()
+            for sl, tl in sents]
+    new = [i for i, k in enumerate(keys) if k not in links]
+    if new:
+        sl_ids: Dict[str, int] = {}
+        tl_ids: Dict[str, int] = {}
+        toks = []
+        for i in new:
+            sl, tl = sents[i]
+            toks.append(([sl_ids.setdefault(w, len(sl_ids)) for w in sl],
+                         [tl_ids.setdefault(w, len(tl_ids)) for w in tl]))
+        priors = read_priors(priors_fname)
+        prior_text = None
+        if links:
+            prior_text = index_priors(priors, sl_ids, tl_ids)
+        algs = run_eflomal(toks, prior_text)
+        os.makedirs(store, exist_ok=True)
+        with open(links_fname, 'a') as f:
+            for i, (sl, tl) in zip(new, algs):
+                links[keys[i]] = ' '.join('%s-%s' % x for x in zip(sl, tl))
+                f.write('%s\t%s\n' % (keys[i], links[keys[i]]))
+                count_priors(priors, *sents[i], sl, tl)
+        write_priors(priors_fname, priors)
+    return Alignments.fromtext(''.join(links[k] + '\n' for k in keys))
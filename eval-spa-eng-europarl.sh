@@ -1,7 +1,7 @@
 #!/bin/bash
 
 morph () {
-    apertium -d "../apertium-data/apertium-$1" "$1-tagger" | apertium-pretransfer
+    ./corpus.py "$1" "../apertium-data/apertium-$1"
 }
 
 gen_morph () {
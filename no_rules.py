@@ -1,5 +1,5 @@
 #!/usr/bin/python3
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Dict
 import subprocess, tempfile
 from objects import *
 import corpus
@@ -34,33 +34,92 @@ def evaluate_rule(corp: Corpus, rl: Rule, constituents: List[List[Tuple[Tuple[in
                 bad += 1
     return (good, bad)
 
+def evaluate_rules(corp: Corpus, rules: List[Rule], constituents: List[List[Tuple[Tuple[int, int], bool]]]) -> List[Tuple[int, int]]:
+    '''evaluate_rule() for every rule in rules, but with one pass over each
+    sentence for all the rules that just match the first tags of two nodes'''
+    scores = [[0, 0] for rl in rules]
+    pairs: Dict[Tuple[str, str], List[int]] = {}
+    other = []
+    for n, rl in enumerate(rules):
+        if len(rl.inputs) == 2 and all(not inp.lemma and len(inp.tags) == 1 and inp.tags[0] != '*' for inp in rl.inputs):
+            pairs.setdefault((rl.inputs[0].tags[0], rl.inputs[1].tags[0]), []).append(n)
+        else:
+            other.append(n)
+    for sen, con in zip(corp.sens, constituents):
+        good = set(c[0] for c in con)
+        # a single tag matches a node if it's the first of the node's tags
+        tags = [(ch.match_surface()[1] or [None])[0] for ch in sen.sl.children]
+        for i in range(len(tags) - 1):
+            for n in pairs.get((tags[i], tags[i+1]), []):
+                scores[n][0 if (i, i+1) in good else 1] += 1
+    for n in other:
+        scores[n] = evaluate_rule(corp, rules[n], constituents)
+    return [tuple(s) for s in scores]
+
 def add_rules(corp: Corpus, prefix: str) -> List[Rule]:
     rules, constituents = list_possible_rules(corp, prefix)
-    rule_scores = [evaluate_rule(corp, r, constituents) for r in rules]
+    rule_scores = evaluate_rules(corp, rules, constituents)
     rule_ls = list(zip(rules, rule_scores))
     rule_ls.sort(reverse=True, key=lambda x: x[1][0] + x[1][1])
     for r, s in rule_ls:
         print('%s\t%s' % (str(r), s))
+    if not rule_ls:
+        return []
+    # the best rule is always kept, the rest only if they're common enough
+    ls = [rule_ls[0][0]] + [rl for rl, score in rule_ls[1:]
+                            if score[0] + score[1] >= (len(corp.sens) / 100.0)]
+    return select_rules(ls)
+
+def select_rules(rules: List[Rule]) -> List[Rule]:
+    '''greedily take each rule in order unless it overlaps one already taken'''
+    # overlap() requires other to contain self's first tag
+    # or self to contain other's first tag after its own first
+    containing: Dict[str, List[int]] = {}
+    starting: Dict[str, List[int]] = {}
+    for n, rl in enumerate(rules):
+        for tag in set(inp.tags[0] for inp in rl.inputs):
+            containing.setdefault(tag, []).append(n)
+        starting.setdefault(rl.inputs[0].tags[0], []).append(n)
     ret = []
-    while rule_ls:
-        todo = []
-        cur = rule_ls[0][0]
-        for rl, score in rule_ls[1:]:
-            if score[0] + score[1] < (len(corp.sens) / 100.0):
-                break
-            if not cur.overlap(rl):
-                todo.append((rl, score))
-        ret.append(cur)
-        rule_ls = todo
+    removed = set()
+    for n, rl in enumerate(rules):
+        if n in removed:
+            continue
+        ret.append(rl)
+        maybe = containing.get(rl.inputs[0].tags[0], [])
+        for inp in rl.inputs[1:]:
+            maybe = maybe + starting.get(inp.tags[0], [])
+        for m in maybe:
+            if m > n and m not in removed and rl.overlap(rules[m]):
+                removed.add(m)
+    return ret
+
+def applicable(corp: Corpus, rules: List[Rule]) -> List[Sentence]:
+    '''the sentences where any of rules could build a chunk over some span
+    that corp.grammar's rules (and these) could build over the words
+    retreeing the rest with those rules added wouldn't change them'''
+    grammar = dict(corp.grammar.rules) if corp.grammar else {}
+    grammar.update((rl.name, rl) for rl in rules)
+    names = set(rl.name for rl in rules)
+    ret = []
+    for sen in corp.sens:
+        chart = buildable(list(sen.sl.iterchildren()), list(grammar.values()))
+        if any(nd.tlem in names for nodes in chart.values() for nd in nodes if nd.children):
+            ret.append(sen)
     return ret
 
 if __name__ == '__main__':
     parser = corpus.make_corpus_argparse('build rules from corresponding word/phrase pairs')
     parser.add_argument('rtx_file', help='file to write generated rules to')
     args = parser.parse_args()
-    corp = corpus.get_corpus(args)
+    grammar = Grammar()
+    corp = corpus.get_corpus(args, grammar)
     rls = []
     for i in range(10):
-        rls += add_rules(corp, 'PHRASE_' + str(i))
-        generate_rule_file(args.rtx_file, rls)
-        corp.compile_and_retree(args.rtx_file)
+        new_rls = add_rules(corp, 'PHRASE_' + str(i))
+        for rl in new_rls:
+            grammar.add_rule(rl)
+        rls += new_rls
+        generate_rule_file(args.rtx_file, grammar, rls)
+        # the other sentences keep the trees and alignments they have
+        corp.compile_and_retree(args.rtx_file, applicable(corp, new_rls))
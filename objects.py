@@ -1,17 +1,19 @@
 #!/usr/bin/env python3
 from typing import List, Tuple, Optional, Dict, Union
-import itertools
 import subprocess
-import tempfile
-from tags import Attribute
+import threading
+import queue
+import hashlib
+import shutil
+import os
+from tags import Attribute, load_attributes, lookup_tag
+from cache import CACHE_DIR
 
 class Pattern:
-    all_patterns = {}
     def __init__(self, pos_tag):
         self.pos_tag = pos_tag
         self.tags = []
         # TODO: conditionals (i.e. <vblex><pres><p1><sg> vs <vblex><inf>)
-        Pattern.all_patterns[pos_tag] = self
     def __str__(self):
         tg = '.'.join(self.tags)
         if tg:
@@ -34,6 +36,43 @@ class Clip:
             ret += '=' + str(self.val)
         return ret
 
+class TagMatcher:
+    '''a tag pattern, compiled to check whether a list of tags begins with it
+    * matches any number of tags, but the list can't end there'''
+    def __init__(self, pat: List[str]):
+        self.anchored = not pat or pat[0] != '*'
+        self.trailing = bool(pat) and pat[-1] == '*'
+        # the runs of literal tags between *s
+        self.runs: List[List[str]] = [[]]
+        for tag in pat:
+            if tag == '*':
+                self.runs.append([])
+            else:
+                self.runs[-1].append(tag)
+        self.first = self.runs[0] if self.anchored else []
+        self.runs = [r for r in self.runs[1 if self.anchored else 0:] if r]
+    def match_at(self, tags: List[str], run: List[str], i: int) -> bool:
+        if len(tags) - i < len(run):
+            return False
+        for t in run:
+            if tags[i] != t:
+                return False
+            i += 1
+        return True
+    def match(self, tags: List[str]) -> bool:
+        if not self.match_at(tags, self.first, 0):
+            return False
+        i = len(self.first)
+        # leftmost is best, since it leaves the most tags for the rest
+        for run in self.runs:
+            for j in range(i, len(tags) - len(run) + 1):
+                if self.match_at(tags, run, j):
+                    i = j + len(run)
+                    break
+            else:
+                return False
+        return i < len(tags) or not self.trailing
+
 class InputNode:
     def __init__(self, tags: Optional[List[str]],
                        lemma: Optional[str] = '',
@@ -41,6 +80,11 @@ class InputNode:
         self.lemma = lemma
         self.tags = tags
         self.clips = clips or []
+        self.matcher: Optional[TagMatcher] = None
+    def match_tags(self, tags: List[str]) -> bool:
+        if self.matcher is None:
+            self.matcher = TagMatcher(self.tags)
+        return self.matcher.match(tags)
     def __str__(self):
         ret = self.lemma + '@' if self.lemma else ''
         return ret + '.'.join(self.tags + ['$' + c for c in self.clips])
@@ -58,14 +102,12 @@ class OutputNode:
         return f'{self.source}{s}'
 
 class Rule:
-    all_rules = {}
     def __init__(self, parent: str, children: List[str]):
         self.parent = parent
         self.inputs = [InputNode([tag]) for tag in children]
         self.outputs = [OutputNode(i+1, []) for i in range(len(self.inputs))]
         self.instances = []
         self.name = (parent + '_' + '_'.join(children)).lower()
-        Rule.all_rules[self.name] = self
     def __str__(self):
         ins = ' '.join(map(str, self.inputs))
         outs = ' _ '.join(map(str, self.outputs))
@@ -84,21 +126,45 @@ class Rule:
                     return True
         return False
 
-def generate_rule_file(fname: str, rules: Optional[List[Rule]] = None):
-    for rl in (rules or Rule.all_rules.values()):
-        if rl.parent not in Pattern.all_patterns:
-            Pattern(rl.parent)
+class Grammar:
+    '''the rules, patterns and attributes of one grammar being learned
+    nothing else refers to them, so several grammars can be learned in one process'''
+    def __init__(self):
+        self.rules: Dict[str, Rule] = {}
+        self.patterns: Dict[str, Pattern] = {}
+        self.attrs: Dict[str, Attribute] = {}
+    def add_rule(self, rule: Rule) -> Rule:
+        self.rules[rule.name] = rule
+        return rule
+    def add_pattern(self, pos_tag: str) -> Pattern:
+        if pos_tag not in self.patterns:
+            self.patterns[pos_tag] = Pattern(pos_tag)
+        return self.patterns[pos_tag]
+    def lookup_attribute(self, tag: str) -> Optional[Attribute]:
+        '''the attribute which tag is a value of, loading them from the tag database if need be'''
+        if len(self.attrs) == 0:
+            self.attrs = load_attributes()
+        return self.attrs.get(lookup_tag(tag))
+    def add_instances(self, lu: "LU"):
+        '''record lu and its descendants as instances of the rules that made them'''
+        if lu.tlem in self.rules:
+            self.rules[lu.tlem].instances.append(lu)
+        for ch in lu.children:
+            self.add_instances(ch)
+
+def generate_rule_file(fname: str, grammar: Grammar, rules: Optional[List[Rule]] = None):
+    for rl in (rules or grammar.rules.values()):
+        grammar.add_pattern(rl.parent)
         for inp in rl.inputs:
-            if inp.tags[0] not in Pattern.all_patterns:
-                Pattern(inp.tags[0])
+            grammar.add_pattern(inp.tags[0])
     with open(fname, 'w') as f:
-        for name, attr in sorted(Attribute.all_attrs.items()):
+        for name, attr in sorted(grammar.attrs.items()):
             f.write(str(attr) + '\n')
         f.write('\n\n')
-        for name, pat in sorted(Pattern.all_patterns.items()):
+        for name, pat in sorted(grammar.patterns.items()):
             f.write(str(pat) + '\n')
         f.write('\n\n')
-        for rule in (rules or sorted(Rule.all_rules.values())):
+        for rule in (rules or [rl for name, rl in sorted(grammar.rules.items())]):
             f.write(str(rule) + '\n\n')
 
 class LU:
@@ -115,8 +181,6 @@ class LU:
         self.children_possible: List[Tuple[Tuple[int, int], List[Tuple[Tuple[int, int], int]]]] = []
         self.possible: List[Tuple[int, int]] = []
         self.idx = []
-        if self.tlem in Rule.all_rules:
-            Rule.all_rules[self.tlem].instances.append(self)
     def __str__(self):
         sl = self.slem + ''.join('<%s>' % x for x in self.stags)
         tl = self.tlem + ''.join('<%s>' % x for x in self.ttags)
@@ -142,21 +206,10 @@ class LU:
         if node.lemma:
             if (chunk and self.tlem != node.lemma) or (not chunk and self.slem != node.lemma):
                 return False
-        def compare_tags(tags: List[str], pat: List[str]):
-            if len(pat) == 0:
-                return True
-            elif pat[0] == '*':
-                return any(compare_tags(tags[n:], pat[1:]) for n in range(len(tags)))
-            elif len(tags) == 0:
-                return False
-            elif tags[0] == pat[0]:
-                return compare_tags(tags[1:], pat[1:])
-            else:
-                return False
         if chunk:
-            return compare_tags(self.ttags, node.tags)
+            return node.match_tags(self.ttags)
         else:
-            return compare_tags(self.stags, node.tags)
+            return node.match_tags(self.stags)
     def assign_alignment(self, align: Dict[int, List[int]], index: Optional[int] = 0) -> int:
         '''set self.possible based on output of word aligner
         align is {source_index: [target_indecies]}
@@ -176,7 +229,10 @@ class LU:
             for ch in self.children:
                 n = ch.assign_alignment(align, n+1)
             return n
-    def align_tree_to_flat(self, words: List["LU"]):
+    def align_tree_to_flat(self, words: List["LU"], beam: int = 0):
+        '''find the spans of words that self could be aligned to
+        beam limits how many partial alignments of the children are kept
+        at each step, preferring the narrowest (0 for no limit)'''
         if len(self.possible) > 0:
             return self.possible
         ret = []
@@ -189,41 +245,37 @@ class LU:
         else:
             ops = []
             for i, ch in enumerate(self.children):
-                ls = [(a,i) for a in ch.align_tree_to_flat(words)]
+                ls = ch.align_tree_to_flat(words, beam)
                 if ls or len(ch.children) > 0:
-                    ops.append(ls)
-            for op in itertools.product(*ops):
-                ls = list(op)
-                ls.sort()
-                for i in range(len(ls)-1):
-                    l = ls[i][0][1]
-                    r = ls[i+1][0][0]
-                    if l == -1:
-                        continue
-                    if not all(x.skippable for x in words[l+1:r]):
-                        break
-                else:
-                    ls2 = [l for l in ls if l[0][0] != -1]
-                    ap = None
-                    if ls2:
-                        ap = (ls2[0][0][0], ls2[-1][0][1])
-                    else:
-                        ap = (-1, -1)
-                    if ap not in ret:
-                        ret.append(ap)
-                    self.children_possible.append((ret[-1], ls))
+                    ops.append((i, ls))
+            if all(ls for i, ls in ops):
+                for ap, ls in align_children(ops, words, beam):
+                    ret.append(ap)
+                    self.children_possible.append((ap, ls))
         self.possible = ret
         return ret
     def filter_align(self, ok):
         pos = [x for x in self.possible if x in ok]
-        self.possible = []
-        # this loop makes us prefer narrower alignments
-        for p in pos:
-            for q in pos:
-                if p[0] <= q[0] and p[1] >= q[1] and p != q:
-                    break
-            else:
-                self.possible.append(p)
+        # prefer narrower alignments: drop any span that contains another
+        # go from the right so that min_end covers every span starting
+        # further right, then check spans with the same start separately
+        dominated = set()
+        min_end = None
+        by_start = sorted(pos, reverse=True)
+        j = 0
+        while j < len(by_start):
+            k = j
+            while k < len(by_start) and by_start[k][0] == by_start[j][0]:
+                k += 1
+            group = by_start[j:k]
+            shortest = group[-1][1]
+            for p in group:
+                if p[1] > shortest or (min_end is not None and min_end <= p[1]):
+                    dominated.add(p)
+            if min_end is None or shortest < min_end:
+                min_end = shortest
+            j = k
+        self.possible = [p for p in pos if p not in dominated]
         self.children_possible = [x for x in self.children_possible if x[0] in self.possible]
         for i, ch in enumerate(self.children):
             pos = []
@@ -324,6 +376,109 @@ class LU:
                 ret.append(tuple(range(s, s+len(rl.inputs))))
         return ret
 
+def buildable(words: List[LU], rules: List[Rule]) -> Dict[Tuple[int, int], List[LU]]:
+    '''every chunk that rules could build over each span of words
+    (and the words themselves), found bottom-up like a CKY parser
+    returns {(start, end): nodes}; the chunks are labelled as rtx-proc
+    would label them, with the rule's name and parent tag'''
+    chart: Dict[Tuple[int, int], List[LU]] = {}
+    # (start, end) -> (rule, number of its inputs matched) for rules
+    # which have matched part of the way along that span
+    partial: Dict[Tuple[int, int], List[Tuple[Rule, int]]] = {}
+    n = len(words)
+    for length in range(1, n+1):
+        for i in range(n - length + 1):
+            j = i + length
+            nodes = [words[i]] if length == 1 else []
+            names = set()
+            part = []
+            for k in range(i+1, j):
+                for rl, m in partial.get((i, k), []):
+                    for nd in chart[(k, j)]:
+                        if nd.compatible(rl.inputs[m]):
+                            if m + 1 < len(rl.inputs):
+                                part.append((rl, m + 1))
+                            elif rl.name not in names:
+                                names.add(rl.name)
+                                nodes.append(LU('', [], rl.name, [rl.parent], words[i:j]))
+                            break
+            # nodes grows as one-input rules match
+            for nd in nodes:
+                for rl in rules:
+                    if not nd.compatible(rl.inputs[0]):
+                        continue
+                    if len(rl.inputs) > 1:
+                        part.append((rl, 1))
+                    elif rl.name not in names:
+                        names.add(rl.name)
+                        nodes.append(LU('', [], rl.name, [rl.parent], words[i:j]))
+            chart[(i, j)] = nodes
+            partial[(i, j)] = list(set(part))
+    return chart
+
+def align_children(ops: List[Tuple[int, List[Tuple[int, int]]]], words: List[LU], beam: int = 0) -> List[Tuple[Tuple[int, int], List[Tuple[Tuple[int, int], int]]]]:
+    '''combine the possible spans of some children (ops is [(child index, spans)])
+    into spans of their parent
+    a combination is consistent if, when its spans are sorted, every word
+    between one span and the next is skippable; children aligned to (-1, -1)
+    are ignored, and the parent span runs from the start of the first
+    span to the end of the last
+    returns each parent span with every (child span, child index) that
+    occurs in some consistent combination giving it'''
+    # unskippable[k] is the number of unskippable words before k
+    unskippable = [0]
+    for w in words:
+        unskippable.append(unskippable[-1] + (0 if w.skippable else 1))
+    optional = [(-1, -1) in ls for i, ls in ops]
+    real = [sorted((sp, i) for sp in ls if sp != (-1, -1)) for i, ls in ops]
+    full = (1 << len(ops)) - 1
+    results: Dict[Tuple[int, int], set] = {}
+    # rather than trying every combination, build the sorted sequence of
+    # spans one at a time
+    # state: (children done, last span, start of first span) -> pairs used
+    # children are done once they're in the sequence or can no longer be
+    # added to it (and so are aligned to (-1, -1))
+    states: Dict[Tuple[int, Optional[Tuple[Tuple[int, int], int]], int], set] = {(0, None, -1): set()}
+    while states:
+        new_states: Dict[Tuple[int, Optional[Tuple[Tuple[int, int], int]], int], set] = {}
+        for (done, last, first), used in states.items():
+            if all(optional[k] for k in range(len(ops)) if not done & (1 << k)):
+                ap = (first, last[0][1]) if last else (-1, -1)
+                pairs = results.setdefault(ap, set())
+                pairs.update(used)
+                pairs.update(((-1, -1), ops[k][0]) for k in range(len(ops)) if not done & (1 << k))
+            for k in range(len(ops)):
+                if done & (1 << k):
+                    continue
+                for key in real[k]:
+                    if last is not None:
+                        if key <= last:
+                            continue
+                        l = last[0][1]
+                        r = key[0][0]
+                        if r > l + 1 and unskippable[r] != unskippable[l+1]:
+                            continue
+                    nd = done | (1 << k)
+                    dropped = []
+                    for m in range(len(ops)):
+                        if nd & (1 << m) or (real[m] and real[m][-1] > key):
+                            continue
+                        if not optional[m]:
+                            break
+                        nd |= (1 << m)
+                        dropped.append(((-1, -1), ops[m][0]))
+                    else:
+                        st = (nd, key, first if last else key[0][0])
+                        ls = new_states.setdefault(st, set())
+                        ls.update(used)
+                        ls.add(key)
+                        ls.update(dropped)
+        if beam and len(new_states) > beam:
+            keep = sorted(new_states, key=lambda st: (st[1][0][1] - st[2], st))[:beam]
+            new_states = {st: new_states[st] for st in keep}
+        states = new_states
+    return [(ap, sorted(ls)) for ap, ls in results.items()]
+
 def parse_tree(line: str, side: str = 'both') -> LU:
     assert(line[0] == '^')
     assert(line[-1] == '$')
@@ -376,10 +531,12 @@ def parse_file(file, sep='\n', side: str = 'both') -> List[LU]:
     return ret
 
 class Sentence:
-    def __init__(self, sl: LU, tl: LU, align: Optional[Dict[int, List[int]]] = None):
+    def __init__(self, sl: LU, tl: LU, align: Optional[Dict[int, List[int]]] = None, beam: int = 0):
         self.sl = sl
         self.tl = tl
         self.align = align
+        # see LU.align_tree_to_flat()
+        self.beam = beam
         if self.align:
             self.sl.assign_alignment(align)
     def source_text(self) -> str:
@@ -388,18 +545,93 @@ class Sentence:
         self.sl = new_sl
         if self.align:
             self.sl.assign_alignment(self.align)
-            self.sl.align_tree_to_flat(self.tl.children)
+            self.sl.align_tree_to_flat(self.tl.children, self.beam)
+
+def compile_rtx(rtx_filename: str) -> str:
+    '''compile rtx_filename and return the name of the binary
+    binaries are kept in CACHE_DIR, keyed by the content of the file
+    and the version of rtx-comp, so an unchanged grammar is only compiled once'''
+    h = hashlib.sha256()
+    comp = shutil.which('rtx-comp')
+    if comp:
+        st = os.stat(comp)
+        h.update(('%s %s %s\n' % (comp, st.st_size, st.st_mtime_ns)).encode('utf-8'))
+    with open(rtx_filename, 'rb') as f:
+        h.update(f.read())
+    path = os.path.join(CACHE_DIR, 'rtx', h.hexdigest() + '.bin')
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # compile then rename so a concurrent run never reads half a file
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        proc = subprocess.run(['rtx-comp', rtx_filename, tmp])
+        if proc.returncode != 0 or not os.path.exists(tmp):
+            raise Exception('Compiling %s failed' % rtx_filename)
+        os.replace(tmp, path)
+    return path
 
 class Corpus:
-    def __init__(self, sens: List[Sentence]):
+    def __init__(self, sens: List[Sentence], jobs: int = 1, grammar: Optional[Grammar] = None):
         self.sens: List[Sentence] = sens
-    def retree(self, rtx_bin_filename: str):
-        txt = '\n\0'.join(s.source_text() for s in self.sens)
-        proc = subprocess.run(['rtx-proc', '-z', '-T', '-m', 'flat', rtx_bin_filename],
-                              input=txt, encoding='utf-8', stdout=subprocess.PIPE)
-        for sen, line in zip(self.sens, proc.stdout.split('\0')):
+        self.jobs = jobs
+        self.grammar = grammar
+        if grammar:
+            for sen in sens:
+                grammar.add_instances(sen.sl)
+    def retree(self, rtx_bin_filename: str, sens: Optional[List[Sentence]] = None):
+        '''reparse the source side of sens (default: every sentence)
+        with rtx-proc, split between self.jobs processes'''
+        if sens is None:
+            sens = self.sens
+        size = max(1, -(-len(sens) // max(1, self.jobs)))
+        # (sentence, its new tree as text) from every process, or None when one finishes
+        results: queue.Queue = queue.Queue()
+        # feed each process from its own thread and read from another, so
+        # that none of them block on a full pipe while we're busy elsewhere
+        def feed(stdin, shard):
+            for j, s in enumerate(shard):
+                if j > 0:
+                    stdin.write(b'\n\0')
+                stdin.write(s.source_text().encode('utf-8'))
+            stdin.close()
+        def drain(stdout, shard):
+            buf = b''
+            j = 0
+            while True:
+                chunk = stdout.read1(65536)
+                if not chunk:
+                    break
+                *done, buf = (buf + chunk).split(b'\0')
+                for line in done:
+                    if j < len(shard):
+                        results.put((shard[j], line.decode('utf-8')))
+                        j += 1
+            if j < len(shard):
+                results.put((shard[j], buf.decode('utf-8')))
+            results.put(None)
+        workers = []
+        for i in range(0, len(sens), size):
+            shard = sens[i:i+size]
+            proc = subprocess.Popen(['rtx-proc', '-z', '-T', '-m', 'flat', rtx_bin_filename],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            threads = [threading.Thread(target=feed, args=(proc.stdin, shard)),
+                       threading.Thread(target=drain, args=(proc.stdout, shard))]
+            for t in threads:
+                t.start()
+            workers.append((proc, threads))
+        # parse here rather than in the threads, since they'd all update self.grammar
+        running = len(workers)
+        while running:
+            item = results.get()
+            if item is None:
+                running -= 1
+                continue
+            sen, line = item
             sen.update_sl(parse_tree('^root{ ' + line.strip() + ' }$'))
-    def compile_and_retree(self, rtx_filename: str):
-        binfile = tempfile.NamedTemporaryFile()
-        subprocess.run(['rtx-comp', rtx_filename, binfile.name])
-        self.retree(binfile.name)
+            if self.grammar:
+                self.grammar.add_instances(sen.sl)
+        for proc, threads in workers:
+            proc.wait()
+            for t in threads:
+                t.join()
+    def compile_and_retree(self, rtx_filename: str, sens: Optional[List[Sentence]] = None):
+        self.retree(compile_rtx(rtx_filename), sens)
@@ -1,13 +1,36 @@
 #!/usr/bin/env python3
-from typing import List, Tuple, Optional, Dict, Union
+from typing import List, Tuple, Optional, Dict, Union, Iterator, Set, Sequence
 import itertools
 import subprocess
+import multiprocessing
+import threading
+import functools
 import tempfile
 from tags import Attribute
-from eflomal_wrapper import run_eflomal, postedit_eflomal
+from eflomal_wrapper import run_eflomal, postedit_eflomal, align_incremental
+from vocab import Vocab
 from collections import defaultdict
+import re
+import sys
+import os
+
+# built by ./configure --enable-python-bindings
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+try:
+    import pyalign
+except ImportError:
+    pyalign = None
+
+# ^lemma, then tags (anything else before the next / $ or { is ignored),
+# then an optional /target section, then whichever of $ or { ends the label
+LABEL_RE = re.compile(r'\^((?:[^\\</${]|\\.)*)((?:<(?:[^\\>]|\\.)*>|[^\\/${<]|\\.)*)(?:/(?:[^\\${]|\\.)*)?([${])', re.S)
+TAG_RE = re.compile(r'<((?:[^\\>]|\\.)*)>|\\.|[^\\<]+', re.S)
+SIMPLE_TAG_RE = re.compile(r'<([^>]*)>')
+# everything between sibling nodes
+SKIP_RE = re.compile(r'(?:[^\\^}]|\\.)*', re.S)
 
 class LU:
+    __slots__ = ('idx', 'lem', 'tags', 'children', 'align', 'children_options', 'word')
     def __init__(self, idx: int, lem: str, tags: List[str], children: List["LU"]):
         self.idx = idx
         self.lem = lem
@@ -15,80 +38,57 @@ class LU:
         self.children = children
         self.align: List[int] = []
         self.children_options: List[List[int]] = []
+        self.word = -1
     def __str__(self):
         return self.__repr__()
     def __repr__(self):
         return '^' + self.lem + ''.join('<%s>' % t for t in self.tags) + '{' + ' '.join(map(str, self.children)) + '}$'
     def fromstring(s: str) -> "LU":
-        assert(s[0] == '^')
-        assert(s[-1] == '$')
-        lem = ''
-        tags = []
-        children = []
-        start = 1
-        i = 1
-        loc = 'lem'
-        depth = 0
-        while i < len(s):
-            if s[i] == '\\':
+        lu, end = LU.parse(s, 0)
+        assert(end == len(s))
+        return lu
+    def parse(s: str, i: int) -> Tuple["LU", int]:
+        '''parse the tree starting at s[i] without copying substrings
+        returns the tree and the offset just past its final $'''
+        stack: List[LU] = []
+        while True:
+            m = LABEL_RE.match(s, i)
+            assert(m)
+            tags = m.group(2)
+            if '\\' in tags:
+                tags = [t.group(1) for t in TAG_RE.finditer(tags) if t.group(1) is not None]
+            else:
+                tags = SIMPLE_TAG_RE.findall(tags)
+            # the same lemmas and tags occur on every line, so share the strings
+            lu = LU(-1, sys.intern(m.group(1)), list(map(sys.intern, tags)), [])
+            i = m.end()
+            if m.group(3) == '{':
+                stack.append(lu)
+            elif stack:
+                stack[-1].children.append(lu)
+            else:
+                return lu, i
+            i = SKIP_RE.match(s, i).end()
+            while not s.startswith('^', i):
+                assert(s.startswith('}$', i))
+                lu = stack.pop()
                 i += 2
-                continue
-            if loc == 'lem' and s[i] in '</${':
-                lem = s[start:i]
-                start = i
-                if s[i] == '<':
-                    start += 1
-                    loc = 'tags'
-                elif s[i] == '/':
-                    loc = 'tl'
-                elif s[i] == '$':
-                    assert(i == len(s) - 1)
-                    break
-                elif s[i] == '{':
-                    loc = 'children'
-                    start = i+1
-            elif loc == 'tags' and s[i] == '>':
-                tags.append(s[start:i])
-                loc = 'none'
-            elif loc == 'none' and s[i] == '<':
-                start = i + 1
-                loc = 'tags'
-            elif loc == 'none' and s[i] in '/${':
-                if s[i] == '/':
-                    loc = 'tl'
-                elif s[i] == '$':
-                    assert(i == len(s) - 1)
-                    break
-                elif s[i] == '{':
-                    loc = 'children'
-                    start = i+1
-            elif loc == 'tl' and s[i] in '${':
-                if s[i] == '$':
-                    assert(i == len(s) - 1)
-                    break
-                else:
-                    loc = 'children'
-                    start = i+1
-            elif loc == 'children' and s[i] in '^$}':
-                if s[i] == '^':
-                    depth += 1
-                    if depth == 1:
-                        start = i
-                elif s[i] == '$':
-                    depth -= 1
-                    if depth == 0:
-                        children.append(LU.fromstring(s[start:i+1]))
-                elif depth == 0:
-                    assert(s[i:] == '}$')
-                    break
-            i += 1
-        return LU(-1, lem, tags, children)
+                if not stack:
+                    return lu, i
+                stack[-1].children.append(lu)
+                i = SKIP_RE.match(s, i).end()
     def iter(self):
         yield self
         for ch in self.children:
             yield from ch.iter()
     def printtree(self, left: bool):
         return ('L' if left else 'R') + str(self.idx) + '[' + ' '.join(str(x.idx) for x in self.children) + '](' + ' '.join(map(str, self.align)) + ')'
+    def getword(self, vocab: Vocab) -> int:
+        '''the id in vocab of this node's lemma and first tag
+        a node only ever gets looked up in the vocab of its own side'''
+        if self.word == -1:
+            self.word = vocab.intern((self.lem.lower(), (self.tags or [''])[0]))
+        return self.word
     def pattern(self):
         return '"' + self.lem.lower() + '"@' + (self.tags or ['nothing'])[0]
 
@@ -111,17 +111,26 @@ class Rule:
         if self.weight > 0:
             wgt = ' %s:' % self.weight
         return '%s ->%s %s { %s } ;' % (self.parent, wgt, ' '.join(self.pat), ' _ '.join(out))
+    def key(self) -> Tuple[str, Tuple[int, ...], Tuple[str, ...]]:
+        '''everything other than the pattern that distinguishes two rules'''
+        return (self.parent, tuple(self.order), tuple(self.inserts))
     def conflicts(self, other):
         if self.pat != other.pat:
             return False
-        if self.parent == other.parent and self.order == other.order and self.inserts == other.inserts:
-            return False
-        return True
+        return self.key() != other.key()
     def redundant(self, other):
-        return self.pat == other.pat and self.parent == other.parent and self.order == other.order and self.inserts == other.inserts
+        return self.pat == other.pat and self.key() == other.key()
 
-def strls(ls: List[int]) -> str:
-    return ' '.join(map(str, ls))
+def find_run(ls: List[int], run: List[int]) -> int:
+    '''index of the first place run occurs contiguously in ls, or -1'''
+    i = -1
+    while True:
+        try:
+            i = ls.index(run[0], i+1)
+        except ValueError:
+            return -1
+        if ls[i:i+len(run)] == run:
+            return i
 
 class Sentence:
     def __init__(self, sl: LU, tl: LU):
@@ -135,76 +144,163 @@ class Sentence:
         self.left_leaves = []
         self.right_leaves = []
         for n in self.nodes:
-            n.children_options.append([x.idx for x in n.children])
-            if len(n.children) == 0:
-                if n.idx < self.tl.idx:
-                    self.left_leaves.append(n.idx)
-                else:
-                    self.right_leaves.append(n.idx)
+            if n.children:
+                n.children_options.append([x.idx for x in n.children])
+            elif n.idx < self.tl.idx:
+                self.left_leaves.append(n.idx)
+            else:
+                self.right_leaves.append(n.idx)
+    def bracketings(self) -> Set[Tuple[bool, Tuple[int, ...]]]:
+        '''the side and children of every non-terminal'''
+        return set((self.isleft(i), tuple(x.idx for x in n.children))
+                   for i, n in enumerate(self.nodes) if n.children)
+    def isleft(self, n: int) -> bool:
+        return n < self.tl.idx or n in self.left_virtual
     def printtree(self):
-        return str(len(self.nodes)) + ' ' + ' '.join(x.printtree(x.idx < self.tl.idx) for x in self.nodes)
-    def getwords(self) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
-        left = [(self.nodes[i].lem.lower(), (self.nodes[i].tags or [''])[0]) for i in self.left_leaves]
-        right = [(self.nodes[i].lem.lower(), (self.nodes[i].tags or [''])[0]) for i in self.right_leaves]
+        return str(len(self.nodes)) + ' ' + ' '.join(x.printtree(self.isleft(x.idx)) for x in self.nodes)
+    def getwords(self, sl_vocab: Vocab, tl_vocab: Vocab) -> Tuple[List[int], List[int]]:
+        left = [self.nodes[i].getword(sl_vocab) for i in self.left_leaves]
+        right = [self.nodes[i].getword(tl_vocab) for i in self.right_leaves]
         return (left, right)
-    def setwordalignments(self, alg: Dict[int, int]):
-        for k in alg:
-            s = self.left_leaves[k]
-            v = alg[k] if isinstance(alg[k], list) else [alg[k]]
-            for i in v:
-                t = self.right_leaves[i]
-                self.nodes[s].align.append(t)
-                self.nodes[t].align.append(s)
+    def setwordalignments(self, sl: Sequence[int], tl: Sequence[int]):
+        '''align the sl[i]th source word with the tl[i]th target word for each i'''
+        for i, j in zip(sl, tl):
+            s = self.left_leaves[i]
+            t = self.right_leaves[j]
+            self.nodes[s].align.append(t)
+            self.nodes[t].align.append(s)
+    def addvirtual(self, n: int, left: bool) -> LU:
+        assert(n == len(self.nodes))
+        self.nodes.append(LU(n, '', [], []))
+        if left:
+            self.left_virtual.append(n)
+        else:
+            self.right_virtual.append(n)
+        return self.nodes[n]
     def addtreealignments(self, alg: str):
-        #print(self.printtree())
-        #print(alg)
         tok = alg.split()
+        count = max([len(self.nodes)] + [int(t[1:]) + 1 for t in tok if t[0] in 'LR'])
+        left = [int(self.isleft(i)) for i in range(len(self.nodes))] + [0] * (count - len(self.nodes))
+        children = [[] for i in range(count)]
+        align = [[] for i in range(count)]
         node = -1
         i = 0
-        #print('len = %s' % len(self.nodes))
-        for t in tok:
-            if t[0] in 'LR':
-                n = int(t[1:])
-                self.nodes.append(LU(node, '', [], []))
-                if t[0] == 'L':
-                    self.left_virtual.append(n)
-                else:
-                    self.right_virtual.append(n)
-        #print('len = %s' % len(self.nodes))
         while i < len(tok):
-            #print(tok[i:])
             if tok[i] == '(':
                 i += 1
                 while tok[i] != ')':
-                    self.nodes[node].align.append(int(tok[i]))
+                    align[node].append(int(tok[i]))
                     i += 1
             elif tok[i] == '[':
                 i += 1
-                #print(node)
-                self.nodes[node].children_options.append([])
                 while tok[i] != ']':
-                    self.nodes[node].children.append(self.nodes[int(tok[i])])
-                    self.nodes[node].children_options[0].append(int(tok[i]))
+                    children[node].append(int(tok[i]))
                     i += 1
             elif tok[i][0] in 'LR':
                 node = int(tok[i][1:])
+                left[node] = int(tok[i][0] == 'L')
             else:
                 node = int(tok[i])
             i += 1
+        self.addtree(left, children, align)
+    def treearrays(self) -> Tuple[List[int], List[int], List[int], List[int], List[int]]:
+        '''the same information as printtree() as flat arrays for pyalign:
+        side of each node (1 for left), offsets into the list of children,
+        the children, offsets into the list of alignments, the alignments'''
+        left = []
+        child_offsets = [0]
+        children = []
+        align_offsets = [0]
+        align = []
+        for i, n in enumerate(self.nodes):
+            left.append(int(self.isleft(i)))
+            children += [x.idx for x in n.children]
+            child_offsets.append(len(children))
+            align += n.align
+            align_offsets.append(len(align))
+        return (left, child_offsets, children, align_offsets, align)
+    def addtreearrays(self, arrays: Tuple[List[int], List[int], List[int], List[int], List[int]]):
+        '''equivalent of addtreealignments() for the output of pyalign'''
+        left, child_offsets, children, align_offsets, align = arrays
+        self.addtree(left,
+                     [children[child_offsets[n]:child_offsets[n+1]] for n in range(len(left))],
+                     [align[align_offsets[n]:align_offsets[n+1]] for n in range(len(left))])
+    def addtree(self, left: List[int], children: List[List[int]], align: List[List[int]]):
+        '''add the virtual nodes and alignments found by align-tree
+        node n is on the left if left[n], and virtual nodes (n >= len(self.nodes))
+        have children[n]; align[n] is what n is aligned to
+        align-tree recreates the virtual nodes of earlier rounds, so a virtual
+        node with the same side and children as one of those is merged into it'''
+        start = len(self.nodes)
+        earlier = defaultdict(list)
+        for i in sorted(self.left_virtual + self.right_virtual):
+            earlier[(self.isleft(i), tuple(x.idx for x in self.nodes[i].children))].append(i)
+        # new node -> the earlier one it's a copy of, or None
+        copies: Dict[int, Optional[int]] = {}
+        def copy_of(n: int) -> Optional[int]:
+            if n < start:
+                return n
+            if n not in copies:
+                copies[n] = None
+                key = (bool(left[n]), tuple(copy_of(c) for c in children[n]))
+                if None not in key[1] and earlier[key]:
+                    copies[n] = earlier[key].pop(0)
+            return copies[n]
+        # in order, so that repeated copies are matched up with earlier nodes in order
+        remap = list(range(start)) + [copy_of(n) for n in range(start, len(left))]
+        new = [n for n in range(start, len(left)) if remap[n] is None]
+        for i, n in enumerate(new):
+            remap[n] = start + i
+        for n in new:
+            self.addvirtual(remap[n], bool(left[n])).children_options.append([remap[c] for c in children[n]])
+        for n in new:
+            v = self.nodes[remap[n]]
+            v.children = [self.nodes[x] for x in v.children_options[0]]
+        for n in range(len(left)):
+            nd = self.nodes[remap[n]]
+            # align-tree only reports the alignments of non-terminals
+            if not nd.children:
+                continue
+            for x in align[n]:
+                x = remap[x]
+                if x not in nd.align:
+                    nd.align.append(x)
+        self.expandvirtual(start)
+    def expandvirtual(self, start: int):
+        '''label the virtual nodes numbered start and above and add them
+        to the children_options of the nodes they could replace children of'''
+        # child -> nodes with that child in at least one option
+        containing = defaultdict(set)
+        for i, nd in enumerate(self.nodes):
+            for op in nd.children_options:
+                for c in op:
+                    containing[c].add(i)
+        known = [set(map(tuple, nd.children_options)) for nd in self.nodes]
         #print('looping virtual!')
         for n in self.left_virtual + self.right_virtual:
-            self.nodes[n].tags.append('_'.join((x.tags or ['*'])[0] for x in self.nodes[n].children))
-            for i, nd in enumerate(self.nodes):
-                if i == n: continue
+            if n < start:
+                # already done in a previous round
+                continue
+            v = self.nodes[n]
+            v.tags.append('_'.join((x.tags or ['*'])[0] for x in v.children))
+            cands = set()
+            for op1 in v.children_options:
+                cands.update(containing[op1[0]])
+            cands.discard(n)
+            for i in sorted(cands):
+                nd = self.nodes[i]
                 newops = []
-                for op1 in self.nodes[n].children_options:
-                    s1 = strls(op1)
+                for op1 in v.children_options:
                     for op2 in nd.children_options:
-                        s2 = strls(op2)
-                        if s1 in s2:
-                            l, r = s2.split(s1, 1)
-                            newops.append([int(x) for x in l.strip().split()] + [n] +
-                                          [int(x) for x in r.strip().split()])
+                        p = find_run(op2, op1)
+                        if p == -1:
+                            continue
+                        op = op2[:p] + [n] + op2[p+len(op1):]
+                        if tuple(op) not in known[i]:
+                            known[i].add(tuple(op))
+                            newops.append(op)
+                if newops:
+                    containing[n].add(i)
                 nd.children_options += newops
     def getrules(self) -> List[Rule]:
         ret = []
@@ -262,98 +358,252 @@ class Sentence:
                             ret.append(Rule(parent, pat, order, inserts, virtual))
         return ret
 
+def merge_rules(index: Dict[Tuple[str, ...], Dict[Tuple, Rule]],
+                non_redundant: List[Rule], rules: List[Rule]):
+    '''add rules to non_redundant, or to the weight of an equivalent rule
+    index maps pattern -> Rule.key() -> the rule in non_redundant'''
+    for r in rules:
+        group = index[tuple(r.pat)]
+        k = r.key()
+        if k in group:
+            group[k].weight += r.weight + 1
+        else:
+            group[k] = r
+            non_redundant.append(r)
+
+def treealign_shard(shard: List[Tuple[str, Sentence]]) -> List[Sentence]:
+    for l, s in shard:
+        s.addtreealignments(l)
+    return [s for l, s in shard]
+
+def getalignments_shard(shard: List[Sentence], max_segments: int = 0) -> List[Sentence]:
+    for s in shard:
+        s.addtreearrays(pyalign.getAlignments(*s.treearrays(), max_segments))
+    return shard
+
+def getrules_shard(shard: List[Sentence]) -> List[Rule]:
+    index = defaultdict(dict)
+    ret = []
+    for s in shard:
+        merge_rules(index, ret, s.getrules())
+    return ret
+
+def split_shards(ls: list, n: int) -> list:
+    '''split ls into at most n contiguous pieces'''
+    size = max(1, -(-len(ls) // n))
+    return [ls[i:i+size] for i in range(0, len(ls), size)]
+
 class Corpus:
-    def __init__(self, sents: List[Sentence]):
+    def __init__(self, sents: List[Sentence], jobs: int = 1, max_segments: int = 0):
         self.sents = sents
-    def wordalign(self, fname=None):
-        sl_ids = {}
-        tl_ids = {}
-        toks = []
-        for s in self.sents:
-            sl, tl = s.getwords()
-            sli = []
-            for w in sl:
-                k = len(sl_ids)
-                if w not in sl_ids:
-                    sl_ids[w] = k
-                sli.append(sl_ids[w])
-            tli = []
-            for w in tl:
-                k = len(tl_ids)
-                if w not in tl_ids:
-                    tl_ids[w] = k
-                tli.append(tl_ids[w])
-            toks.append((sli, tli))
-        algs = []
+        self.jobs = jobs
+        self.max_segments = max_segments
+        # (lowercased lemma, first tag) of the leaves on each side
+        # ids are only assigned in the main process, since workers have their own copy
+        self.sl_vocab = Vocab()
+        self.tl_vocab = Vocab()
+    def map_shards(self, fn, ls: list) -> list:
+        '''apply fn to pieces of ls in a pool of self.jobs processes
+        returns the results in order'''
+        # several pieces per process so that one slow piece doesn't hold up the rest
+        shards = split_shards(ls, self.jobs * 4)
+        with multiprocessing.Pool(self.jobs) as pool:
+            return pool.map(fn, shards)
+    def wordalign(self, fname=None, store=None):
+        '''align words with eflomal, or read the alignments from fname
+        if store is given, only align sentences not in that directory (see align_incremental)'''
         if fname:
             algs = postedit_eflomal(fname)
+        elif store:
+            words = [s.getwords(self.sl_vocab, self.tl_vocab) for s in self.sents]
+            sl_names = ['%s<%s>' % w for w in self.sl_vocab.words]
+            tl_names = ['%s<%s>' % w for w in self.tl_vocab.words]
+            algs = align_incremental([([sl_names[w] for w in sl], [tl_names[w] for w in tl])
+                                      for sl, tl in words], store)
         else:
-            algs = run_eflomal(toks)
-        for s, a in zip(self.sents, algs):
-            s.setwordalignments(a)
-    def biltrans_align(self, fname):
-        def lemtag(s):
-            l = s.split('<')
-            lem = l[0].lower()
-            tg = ''
-            if len(l) > 1:
-                tg = l[1][:-1]
-            return (lem, tg)
-        trans = defaultdict(list)
-        with open(fname) as f:
-            s = f.read()
-            i = 0
-            while '^' in s[i:]:
-                i = s.index('^', i)
-                e = s.index('$', i)
-                lus = s[i+1:e].split('/')
-                sl = lemtag(lus[0])
-                for tl in lus[1:]:
-                    trans[sl].append(lemtag(tl))
-                i = e
-        for s in self.sents:
-            sl, tl = s.getwords()
+            algs = run_eflomal([s.getwords(self.sl_vocab, self.tl_vocab) for s in self.sents])
+        for s, (sl, tl) in zip(self.sents, algs):
+            s.setwordalignments(sl, tl)
+    def biltrans_align(self, fname, index=None):
+        '''align words that fname, the output of biltrans, says translate each other
+        if index is given, the dictionary is read from that file, or saved
+        there if it doesn't exist or is older than fname'''
+        words = [s.getwords(self.sl_vocab, self.tl_vocab) for s in self.sents]
+        trans = defaultdict(set)
+        for sl, tl in read_biltrans_index(fname, index):
+            # words not in the corpus can't be aligned, so don't intern them
+            i = self.sl_vocab.get(sl)
+            j = self.tl_vocab.get(tl)
+            if i != -1 and j != -1:
+                trans[i].add(j)
+        for s, (sl, tl) in zip(self.sents, words):
+            positions = defaultdict(list)
+            for j, v in enumerate(tl):
+                positions[v].append(j)
+            sla = []
+            tla = []
             for i, w in enumerate(sl):
-                if w not in trans:
-                    continue
-                for j, v in enumerate(tl):
-                    if v in trans[w]:
-                        s.setwordalignments({i: j})
-    def treealign(self):
-        print('  running align-tree...')
+                js = [j for v in trans.get(w, ()) for j in positions.get(v, ())]
+                js.sort()
+                sla += [i] * len(js)
+                tla += js
+            s.setwordalignments(sla, tla)
+    def align_tree_command(self) -> List[str]:
+        cmd = ['src/align-tree']
+        if self.max_segments > 0:
+            cmd += ['-m', str(self.max_segments)]
+        return cmd
+    def run_align_tree(self, sents: List[Sentence]) -> Iterator[str]:
         tmp1 = tempfile.NamedTemporaryFile('w+')
         tmp2 = tempfile.NamedTemporaryFile('w+')
-        tmp1.write('\n'.join(s.printtree() for s in self.sents))
+        tmp1.write('\n'.join(s.printtree() for s in sents))
         tmp1.seek(0)
-        subprocess.run(['src/align-tree', tmp1.name, tmp2.name])
+        subprocess.run(self.align_tree_command() + [tmp1.name, tmp2.name])
         tmp2.seek(0)
-        txt = tmp2.read()
-        print('  processing alignments...')
-        for l, s in zip(txt.splitlines(), self.sents):
-            s.addtreealignments(l.strip())
-            #print('    done with one')
-    def getrules(self):
-        rules = []
-        for s in self.sents:
-            rules += s.getrules()
-        non_conflict = []
-        non_redundant = []
-        for r in rules:
-            if not any(r.conflicts(x) for x in rules) and not any(r.redundant(x) for x in non_conflict):
-                non_conflict.append(r)
-            for other in non_redundant:
-                if r.redundant(other):
-                    other.weight += 1
-                    break
+        return iter(tmp2.read().splitlines())
+    def stream_align_tree(self, sents: List[Sentence]) -> Iterator[str]:
+        '''pipe sentences through a single align-tree process
+        and yield its output lines as they are produced'''
+        proc = subprocess.Popen(self.align_tree_command(), stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, encoding='utf-8')
+        def feed():
+            try:
+                for s in sents:
+                    proc.stdin.write(s.printtree() + '\n')
+                proc.stdin.close()
+            except BrokenPipeError:
+                # align-tree exited early; treat it like a short output file
+                pass
+        # write from a separate thread so neither side blocks on a full pipe
+        writer = threading.Thread(target=feed, daemon=True)
+        writer.start()
+        yield from proc.stdout
+        writer.join()
+        proc.wait()
+    def treealign_in_process(self, sents: List[Sentence]) -> List[Sentence]:
+        if pyalign is None:
+            raise Exception('pyalign module not found. Please run ./configure --enable-python-bindings && make')
+        print('  running getAlignments...')
+        if self.jobs > 1:
+            done = []
+            fn = functools.partial(getalignments_shard, max_segments=self.max_segments)
+            for shard in self.map_shards(fn, sents):
+                done += shard
+            return done
+        return getalignments_shard(sents, self.max_segments)
+    def treealign(self, stream: bool = False, in_process: bool = False,
+                  todo: Optional[List[int]] = None) -> List[int]:
+        '''align the trees of the sentences numbered in todo (default: all)
+        returns the numbers of those which gained new virtual nodes'''
+        if todo is None:
+            todo = list(range(len(self.sents)))
+        sents = [self.sents[i] for i in todo]
+        before = [s.bracketings() for s in sents]
+        if in_process:
+            sents = self.treealign_in_process(sents)
+        else:
+            print('  running align-tree...')
+            if stream:
+                lines = self.stream_align_tree(sents)
+            else:
+                lines = self.run_align_tree(sents)
+            print('  processing alignments...')
+            if self.jobs > 1:
+                pairs = [(l.strip(), s) for l, s in zip(lines, sents)]
+                done = []
+                for shard in self.map_shards(treealign_shard, pairs):
+                    done += shard
+                sents = done + sents[len(done):]
             else:
-                non_redundant.append(r)
-        #return non_conflict
-        #return rules
+                for l, s in zip(lines, sents):
+                    s.addtreealignments(l.strip())
+                    #print('    done with one')
+        # with --jobs these are copies made by the worker processes
+        for i, s in zip(todo, sents):
+            self.sents[i] = s
+        # virtual nodes identical to ones from an earlier round are merged
+        # by addtree(), so this only counts ones with new children
+        return [i for i, s, b in zip(todo, sents, before) if s.bracketings() != b]
+    def treealign_rounds(self, rounds: int, stream: bool = False, in_process: bool = False):
+        '''run treealign() repeatedly, each time only on sentences
+        which gained new virtual nodes the time before
+        rounds = 0 means keep going until none do'''
+        todo = None
+        n = 0
+        while rounds == 0 or n < rounds:
+            todo = self.treealign(stream, in_process, todo)
+            n += 1
+            print('  round %s: %s of %s sentences converged' % (n, len(self.sents) - len(todo), len(self.sents)))
+            if not todo:
+                break
+    def getrules(self, no_conflicts: bool = False):
+        '''if no_conflicts is set, leave out every rule whose pattern
+        some other rule rearranges differently'''
+        # pattern -> Rule.key() -> first rule seen with that pattern and key
+        index: Dict[Tuple[str, ...], Dict[Tuple, Rule]] = defaultdict(dict)
+        non_redundant = []
+        if self.jobs > 1:
+            for rules in self.map_shards(getrules_shard, self.sents):
+                merge_rules(index, non_redundant, rules)
+        else:
+            for s in self.sents:
+                merge_rules(index, non_redundant, s.getrules())
+        if no_conflicts:
+            # a pattern with more than one distinct key has conflicting rules
+            return [r for r in non_redundant if len(index[tuple(r.pat)]) == 1]
         return non_redundant
 
-def read_tree_file(fname):
+BILTRANS_RE = re.compile(r'\^([^$]*)\$')
+
+def lemtag(s: str) -> Tuple[str, str]:
+    '''lowercased lemma and first tag of a biltrans analysis'''
+    l = s.split('<')
+    lem = l[0].lower()
+    tg = ''
+    if len(l) > 1:
+        tg = l[1][:-1]
+    return (lem, tg)
+
+def iter_biltrans(fname) -> Iterator[Tuple[Tuple[str, str], Tuple[str, str]]]:
+    '''the distinct (source, target) word pairs in biltrans output'''
+    seen = set()
+    with open(fname) as f:
+        for line in f:
+            for m in BILTRANS_RE.finditer(line):
+                lus = m.group(1).split('/')
+                sl = lemtag(lus[0])
+                for tl in lus[1:]:
+                    pair = (sl, lemtag(tl))
+                    if pair not in seen:
+                        seen.add(pair)
+                        yield pair
+
+def read_biltrans_index(fname, index=None) -> List[Tuple[Tuple[str, str], Tuple[str, str]]]:
+    '''iter_biltrans(fname), via the tab-separated file index if it's up to date'''
+    if index and os.path.exists(index) and os.path.getmtime(index) >= os.path.getmtime(fname):
+        with open(index) as f:
+            return [((l[0], l[1]), (l[2], l[3])) for l in (line.rstrip('\n').split('\t') for line in f)]
+    pairs = list(iter_biltrans(fname))
+    if index:
+        with open(index, 'w') as f:
+            for sl, tl in pairs:
+                f.write('%s\t%s\t%s\t%s\n' % (sl + tl))
+    return pairs
+
+def iter_tree_file(fname):
     with open(fname) as f:
-        return [LU.fromstring(l) for l in f.read().splitlines() if l.strip()]
+        for line in f:
+            line = line.strip()
+            if line:
+                yield LU.fromstring(line)
+
+def read_tree_file(fname):
+    return list(iter_tree_file(fname))
+
+def iter_sentences(sl_fname, tl_fname):
+    '''lazily pair up the trees in two files'''
+    for sl, tl in zip(iter_tree_file(sl_fname), iter_tree_file(tl_fname)):
+        yield Sentence(sl, tl)
     
 if __name__ == '__main__':
     import argparse
@@ -361,22 +611,27 @@ if __name__ == '__main__':
     parser.add_argument('sl_trees', help="file to read source language trees from")
     parser.add_argument('tl_trees', help="file to read target language trees from")
     parser.add_argument('--biltrans', '-b', help="file to read biltrans alignment data from", action='store')
+    parser.add_argument('--biltrans-index', help="file to save the dictionary from --biltrans in, or to read it from if it's newer than that", action='store')
     parser.add_argument('--align', '-a', help="file to read post-editted eflomal data from", action='store')
+    parser.add_argument('--incremental', '-i', help="directory of word alignments and eflomal priors saved by previous runs; only sentences not found there are aligned, and it is then updated", action='store')
     parser.add_argument('--output', '-o', help="output file", action='store')
+    parser.add_argument('--stream', '-s', help="pipe sentences through align-tree rather than using temporary files", action='store_true')
+    parser.add_argument('--in-process', '-p', help="align trees with the pyalign module rather than running align-tree", action='store_true')
+    parser.add_argument('--max-segments', '-m', help="limit on how many ways align-tree splits up the links between two nodes (default: no limit)", type=int, default=0)
+    parser.add_argument('--rounds', '-r', help="maximum number of rounds of tree alignment, 0 to run until no trees change (default 2)", type=int, default=2)
+    parser.add_argument('--no-conflicts', help="leave out rules whose pattern is rearranged differently by other rules", action='store_true')
+    parser.add_argument('--jobs', '-j', help="number of processes to use for tree alignment and rule extraction", type=int, default=1)
     args = parser.parse_args()
 
-    sl = read_tree_file(args.sl_trees)
-    tl = read_tree_file(args.tl_trees)
-    c = Corpus([Sentence(a, b) for a,b in zip(sl, tl)])
+    c = Corpus(list(iter_sentences(args.sl_trees, args.tl_trees)), args.jobs, args.max_segments)
     if args.biltrans:
-        c.biltrans_align(args.biltrans)
+        c.biltrans_align(args.biltrans, args.biltrans_index)
     elif args.align:
         c.wordalign(args.align)
     else:
-        c.wordalign()
-    c.treealign()
-    c.treealign()
-    rls = c.getrules()
+        c.wordalign(store=args.incremental)
+    c.treealign_rounds(args.rounds, args.stream, args.in_process)
+    rls = c.getrules(args.no_conflicts)
     tags = set()
     for rl in rls:
         tags.add(rl.parent)
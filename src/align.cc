@@ -1,39 +1,127 @@
 #include "align.h"
 #include <map>
+#include <algorithm>
+#include <cstdint>
 #include <iostream>
 
-Yield
-getYield(int n, const Tree& nodes)
+// Bit n of a Bits is node n. Yields are only built from terminals, so in
+// practice only the bits of terminal nodes are ever set.
+typedef std::vector<uint64_t> Bits;
+
+bool
+testBit(const Bits& b, int n)
 {
-  Yield ret;
-  if(nodes[n]->children.empty()) {
-    ret.insert(n);
-  } else {
-    for(auto ch : nodes[n]->children) {
-      Yield tmp = getYield(ch, nodes);
-      ret.insert(tmp.begin(), tmp.end());
-    }
+  return (b[n / 64] >> (n % 64)) & 1;
+}
+
+void
+setBit(Bits& b, int n)
+{
+  b[n / 64] |= ((uint64_t)1 << (n % 64));
+}
+
+void
+clearBit(Bits& b, int n)
+{
+  b[n / 64] &= ~((uint64_t)1 << (n % 64));
+}
+
+// whether every bit of a is in b or c
+bool
+isCovered(const Bits& a, const Bits& b, const Bits& c)
+{
+  for(size_t i = 0; i < a.size(); i++) {
+    if(a[i] & ~(b[i] | c[i])) return false;
   }
-  return ret;
+  return true;
 }
 
+// whether a has any bits which are not in b
 bool
-alignedWith(int n, const Yield& y, const Tree& nodes)
+hasOutside(const Bits& a, const Bits& b)
 {
-  if(nodes[n]->align.empty()) return true;
-  for(auto a : nodes[n]->align) {
-    if(y.find(a) != y.end()) return true;
+  for(size_t i = 0; i < a.size(); i++) {
+    if(a[i] & ~b[i]) return true;
   }
   return false;
 }
 
-bool
-yieldContains(const Yield& small, const Yield& large, const Tree& nodes)
+// Yields of every node, computed once, along with what is needed to check
+// yieldContains() with word-wise operations rather than set lookups:
+//   yield[n]: the terminals under n
+//   cover[n]: the terminals which have an alignment to something in yield[n]
+//   unaligned: the terminals with no alignments at all
+// A terminal t is aligned with yield[n] iff it is in cover[n] or unaligned.
+struct YieldTable {
+  std::vector<Bits> yield;
+  std::vector<Bits> cover;
+  Bits unaligned;
+  std::vector<bool> done;
+};
+
+void
+buildYield(int n, const Tree& nodes, YieldTable& tab)
 {
-  for(auto it : small) {
-    if(!alignedWith(it, large, nodes)) return false;
+  if(tab.done[n]) return;
+  tab.done[n] = true;
+  if(nodes[n]->children.empty()) {
+    setBit(tab.yield[n], n);
+    return;
+  }
+  for(auto ch : nodes[n]->children) {
+    buildYield(ch, nodes, tab);
+    for(size_t i = 0; i < tab.yield[n].size(); i++) {
+      tab.yield[n][i] |= tab.yield[ch][i];
+      tab.cover[n][i] |= tab.cover[ch][i];
+    }
   }
-  return true;
+}
+
+void
+buildYields(const Tree& nodes, YieldTable& tab)
+{
+  size_t words = (nodes.size() + 63) / 64;
+  tab.yield.assign(nodes.size(), Bits(words, 0));
+  tab.cover.assign(nodes.size(), Bits(words, 0));
+  tab.unaligned.assign(words, 0);
+  tab.done.assign(nodes.size(), false);
+  for(auto& it : nodes) {
+    if(!it->children.empty()) continue;
+    if(it->align.empty()) {
+      setBit(tab.unaligned, it->id);
+    }
+    for(auto a : it->align) {
+      if(nodes[a]->children.empty()) {
+        setBit(tab.cover[a], it->id);
+      }
+    }
+  }
+  for(auto& it : nodes) {
+    buildYield(it->id, nodes, tab);
+  }
+}
+
+// add b to the alignments of a, keeping tab up to date
+void
+addAlignment(int a, int b, Tree& nodes, YieldTable& tab)
+{
+  if(nodes[a]->children.empty()) {
+    if(nodes[a]->align.empty()) {
+      clearBit(tab.unaligned, a);
+    }
+    if(nodes[b]->children.empty()) {
+      for(size_t n = 0; n < tab.yield.size(); n++) {
+        if(testBit(tab.yield[n], b)) setBit(tab.cover[n], a);
+      }
+    }
+  }
+  nodes[a]->align.insert(b);
+}
+
+bool
+yieldContains(int small, int large, const YieldTable& tab)
+{
+  return isCovered(tab.yield[small], tab.cover[large], tab.unaligned);
 }
 
 Yield
@@ -133,11 +221,27 @@ splitSegments(const std::vector<std::pair<int, int>>& from, bool left,
   return changed || (to.size() > size_was + 1);
 }
 
+// record a set of links as visited, ignoring order
+// returns false if it had already been visited
+bool
+markVisited(const std::vector<std::pair<int, int>>& seg,
+            std::set<std::vector<std::pair<int, int>>>& visited)
+{
+  std::vector<std::pair<int, int>> key = seg;
+  std::sort(key.begin(), key.end());
+  return visited.insert(key).second;
+}
+
 std::vector<std::vector<std::pair<int, int>>>
-findSegments(const std::vector<std::pair<int, int>>& links)
+findSegments(const std::vector<std::pair<int, int>>& links, size_t maxSegments)
 {
   std::vector<std::vector<std::pair<int, int>>> temp1, temp2, ret;
+  // subsets of links which have been returned or queued for splitting
+  // a subset can be reached by dropping its links in any order,
+  // so without this the search repeats itself combinatorially
+  std::set<std::vector<std::pair<int, int>>> found, queued;
   temp1.push_back(links);
+  markVisited(links, queued);
   while(!temp1.empty()) {
     bool changed = false;
     for(auto& it : temp1) {
@@ -149,12 +253,20 @@ findSegments(const std::vector<std::pair<int, int>>& links)
     }
     temp2.clear();
     if(!changed) {
-      ret.insert(ret.end(), temp1.begin(), temp1.end());
+      for(auto& it : temp1) {
+        if(markVisited(it, found)) {
+          ret.push_back(it);
+          if(maxSegments > 0 && ret.size() >= maxSegments) return ret;
+        }
+      }
       for(auto& it : temp1) {
         if(it.size() > 2) {
           for(size_t i = 0; i < it.size(); i++) {
-            temp2.push_back(it);
-            temp2.back().erase(temp2.back().begin()+i);
+            std::vector<std::pair<int, int>> sub = it;
+            sub.erase(sub.begin()+i);
+            if(markVisited(sub, queued)) {
+              temp2.push_back(sub);
+            }
           }
         }
       }
@@ -166,61 +278,47 @@ findSegments(const std::vector<std::pair<int, int>>& links)
 }
 
 void
-getAlignments(std::vector<Node*>& nodes)
+getAlignments(std::vector<Node*>& nodes, size_t maxSegments)
 {
-  std::vector<std::pair<int, Yield>> left, right;
+  std::vector<int> left, right;
   for(auto& it : nodes) {
     if(it->isLeft) {
-      left.push_back(std::make_pair(it->id, getYield(it->id, nodes)));
+      left.push_back(it->id);
     } else {
-      right.push_back(std::make_pair(it->id, getYield(it->id, nodes)));
+      right.push_back(it->id);
     }
   }
+  YieldTable tab;
+  buildYields(nodes, tab);
   std::vector<std::vector<bool>> linr(left.size(), std::vector<bool>(right.size(), false));
   std::vector<std::vector<bool>> rinl(left.size(), std::vector<bool>(right.size(), false));
   for(size_t l = 0; l < left.size(); l++) {
     for(size_t r = 0; r < right.size(); r++) {
-      if(yieldContains(left[l].second, right[r].second, nodes)) {
+      if(yieldContains(left[l], right[r], tab)) {
         linr[l][r] = true;
       }
-      if(yieldContains(right[r].second, left[l].second, nodes)) {
+      if(yieldContains(right[r], left[l], tab)) {
         rinl[l][r] = true;
       }
       if(linr[l][r] && rinl[l][r]) {
-        nodes[left[l].first]->align.insert(right[r].first);
-        nodes[right[r].first]->align.insert(left[l].first);
+        addAlignment(left[l], right[r], nodes, tab);
+        addAlignment(right[r], left[l], nodes, tab);
       }
     }
   }
   std::vector<size_t> ltodo, rtodo;
   for(size_t i = 0; i < left.size(); i++) {
-    if(!nodes[left[i].first]->children.empty() &&
-       nodes[left[i].first]->align.empty()) {
-      bool any_aligned = false;
-      for(auto it : left[i].second) {
-        if(!nodes[it]->align.empty()) {
-          any_aligned = true;
-          break;
-        }
-      }
-      if(any_aligned) {
-        ltodo.push_back(i);
-      }
+    if(!nodes[left[i]]->children.empty() &&
+       nodes[left[i]]->align.empty() &&
+       hasOutside(tab.yield[left[i]], tab.unaligned)) {
+      ltodo.push_back(i);
     }
   }
   for(size_t i = 0; i < right.size(); i++) {
-    if(!nodes[right[i].first]->children.empty() &&
-       nodes[right[i].first]->align.empty()) {
-      bool any_aligned = false;
-      for(auto it : right[i].second) {
-        if(!nodes[it]->align.empty()) {
-          any_aligned = true;
-          break;
-        }
-      }
-      if(any_aligned) {
-        rtodo.push_back(i);
-      }
+    if(!nodes[right[i]]->children.empty() &&
+       nodes[right[i]]->align.empty() &&
+       hasOutside(tab.yield[right[i]], tab.unaligned)) {
+      rtodo.push_back(i);
     }
   }
   std::vector<size_t> ltodo_partial, rtodo_partial;
@@ -228,8 +326,8 @@ getAlignments(std::vector<Node*>& nodes)
     Yield rch_all; // all descendants of potential virtual node
     Yield rpar_all; // all ancestors of potential virtual node
     for(size_t i = 0; i < right.size(); i++) {
-      if(rinl[l][i]) rch_all.insert(right[i].first);
-      if(linr[l][i]) rpar_all.insert(right[i].first);
+      if(rinl[l][i]) rch_all.insert(right[i]);
+      if(linr[l][i]) rpar_all.insert(right[i]);
     }
     Yield rch = getHighest(rch_all, nodes);
     Yield rpar = getLowest(rpar_all, nodes);
@@ -243,9 +341,9 @@ getAlignments(std::vector<Node*>& nodes)
         v->isVirtual = true;
         v->parent = par;
         v->children = ch;
-        v->align.insert(left[l].first);
+        v->align.insert(left[l]);
         nodes.push_back(v);
-        nodes[left[l].first]->align.insert(v->id);
+        nodes[left[l]]->align.insert(v->id);
         continue;
       }
     }
@@ -255,8 +353,8 @@ getAlignments(std::vector<Node*>& nodes)
     Yield lch_all; // all descendants of potential virtual node
     Yield lpar_all; // all ancestors of potential virtual node
     for(size_t i = 0; i < left.size(); i++) {
-      if(linr[i][r]) lch_all.insert(left[i].first);
-      if(rinl[i][r]) lpar_all.insert(left[i].first);
+      if(linr[i][r]) lch_all.insert(left[i]);
+      if(rinl[i][r]) lpar_all.insert(left[i]);
     }
     Yield lch = getHighest(lch_all, nodes);
     Yield lpar = getLowest(lpar_all, nodes);
@@ -270,9 +368,9 @@ getAlignments(std::vector<Node*>& nodes)
         v->isVirtual = true;
         v->parent = par;
         v->children = ch;
-        v->align.insert(right[r].first);
+        v->align.insert(right[r]);
         nodes.push_back(v);
-        nodes[right[r].first]->align.insert(v->id);
+        nodes[right[r]]->align.insert(v->id);
         continue;
       }
     }
@@ -281,8 +379,8 @@ getAlignments(std::vector<Node*>& nodes)
   for(auto l : ltodo_partial) {
     for(auto r : rtodo_partial) {
       std::vector<std::pair<int, int>> links;
-      std::vector<int>& lch = nodes[left[l].first]->children;
-      std::vector<int>& rch = nodes[right[r].first]->children;
+      std::vector<int>& lch = nodes[left[l]]->children;
+      std::vector<int>& rch = nodes[right[r]]->children;
       int real_link_count = 0;
       for(size_t i = 0; i < lch.size(); i++) {
         if(nodes[lch[i]]->align.empty() && nodes[lch[i]]->children.empty()) {
@@ -304,7 +402,7 @@ getAlignments(std::vector<Node*>& nodes)
       }
       if(real_link_count < 2) continue;
       // don't create random virtual nodes for unaligned terminals
-      std::vector<std::vector<std::pair<int, int>>> segments = findSegments(links);
+      std::vector<std::vector<std::pair<int, int>>> segments = findSegments(links, maxSegments);
       for(auto& seg : segments) {
         int minl = lch.size(), maxl = -1, minr = rch.size(), maxr = -1;
         for(auto& pr : seg) {
@@ -321,13 +419,13 @@ getAlignments(std::vector<Node*>& nodes)
         vl->id = nodes.size();
         vl->isLeft = true;
         vl->isVirtual = true;
-        vl->parent = left[l].first;
+        vl->parent = left[l];
 
         Node* vr = new Node;
         vr->id = nodes.size()+1;
         vr->isLeft = false;
         vr->isVirtual = true;
-        vr->parent = right[r].first;
+        vr->parent = right[r];
 
         vl->align.insert(vr->id);
         vr->align.insert(vl->id);
@@ -18,7 +18,11 @@ struct Node {
 typedef std::set<int> Yield;
 typedef std::vector<Node*> Tree;
 
-void getAlignments(Tree& nodes);
+// maxSegments limits how many ways of splitting up the links between
+// a pair of unaligned nodes are returned (0 for no limit); the search
+// stops as soon as that many have been found
+void getAlignments(Tree& nodes, size_t maxSegments = 0);
+void attachParents(Tree& nodes);
 
 Tree readTrees(FILE* in);
 void writeTrees(FILE* out, Tree& nodes);
@@ -14,10 +14,12 @@ void endProgram(char *name)
   cout << "USAGE: " << basename(name) << " [ -h ] [input_file [output_file]]" << endl;
   cout << "Options:" << endl;
 #if HAVE_GETOPT_LONG
-  cout << "  -e, --error:  exit with error if trees cannot be fully aligned" << endl;
-  cout << "  -h, --help:   show this help" << endl;
+  cout << "  -e, --error:           exit with error if trees cannot be fully aligned" << endl;
+  cout << "  -m, --max-segments N:  return at most N ways of splitting the links between two nodes" << endl;
+  cout << "  -h, --help:            show this help" << endl;
 #else
   cout << "  -e: exit with error if trees cannot be fully aligned" << endl;
+  cout << "  -m N: return at most N ways of splitting the links between two nodes" << endl;
   cout << "  -h: show this help" << endl;
 #endif
   exit(EXIT_FAILURE);
@@ -26,12 +28,15 @@ void endProgram(char *name)
 int main(int argc, char *argv[])
 {
   bool error = false;
+  size_t maxSegments = 0;
 
 #if HAVE_GETOPT_LONG
   static struct option long_options[]=
     {
       {"error",             0, 0, 'e'},
-      {"help",              0, 0, 'h'}
+      {"max-segments",      1, 0, 'm'},
+      {"help",              0, 0, 'h'},
+      {0, 0, 0, 0}
     };
 #endif
 
@@ -39,9 +44,9 @@ int main(int argc, char *argv[])
   {
 #if HAVE_GETOPT_LONG
     int option_index;
-    int c = getopt_long(argc, argv, "eh", long_options, &option_index);
+    int c = getopt_long(argc, argv, "em:h", long_options, &option_index);
 #else
-    int c = getopt(argc, argv, "eh");
+    int c = getopt(argc, argv, "em:h");
 #endif
 
     if(c == -1)
@@ -55,6 +60,10 @@ int main(int argc, char *argv[])
       error = true;
       break;
 
+    case 'm':
+      maxSegments = atoi(optarg);
+      break;
+
     case 'h':
     default:
       endProgram(argv[0]);
@@ -93,8 +102,10 @@ int main(int argc, char *argv[])
   while(!feof(in)) {
     Tree nodes = readTrees(in);
     if(nodes.empty()) break;
-    getAlignments(nodes);
+    getAlignments(nodes, maxSegments);
     writeTrees(out, nodes);
+    // flush so that a caller reading from a pipe gets each tree as soon as it's done
+    fflush(out);
     for(size_t i = 0; i < nodes.size(); i++) {
       delete nodes[i];
     }
@@ -0,0 +1,157 @@
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include "align.h"
+
+// Python bindings for getAlignments(), so that objects2.py can align trees
+// without writing them out and running align-tree.
+//
+// Trees are passed as flat arrays (see Sentence.treearrays() in objects2.py):
+//   left: 1 for source nodes, 0 for target nodes
+//   child_offsets, children: node n has children[child_offsets[n]:child_offsets[n+1]]
+//   align_offsets, align: likewise for the nodes each node is aligned to
+// and the same five lists are returned, with any virtual nodes appended.
+
+bool
+readInts(PyObject* obj, const char* name, std::vector<int>& out)
+{
+  PyObject* seq = PySequence_Fast(obj, name);
+  if(seq == NULL) return false;
+  Py_ssize_t len = PySequence_Fast_GET_SIZE(seq);
+  PyObject** items = PySequence_Fast_ITEMS(seq);
+  out.reserve(len);
+  for(Py_ssize_t i = 0; i < len; i++) {
+    long v = PyLong_AsLong(items[i]);
+    if(v == -1 && PyErr_Occurred()) {
+      Py_DECREF(seq);
+      return false;
+    }
+    out.push_back(v);
+  }
+  Py_DECREF(seq);
+  return true;
+}
+
+bool
+checkOffsets(const std::vector<int>& offsets, size_t count, size_t total,
+             const char* name)
+{
+  if(offsets.size() != count + 1 || offsets[0] != 0 ||
+     (size_t)offsets.back() != total) {
+    PyErr_Format(PyExc_ValueError, "%s does not match the number of nodes", name);
+    return false;
+  }
+  for(size_t i = 0; i < count; i++) {
+    if(offsets[i] > offsets[i+1]) {
+      PyErr_Format(PyExc_ValueError, "%s is not sorted", name);
+      return false;
+    }
+  }
+  return true;
+}
+
+PyObject*
+toList(const std::vector<int>& vec)
+{
+  PyObject* ret = PyList_New(vec.size());
+  if(ret == NULL) return NULL;
+  for(size_t i = 0; i < vec.size(); i++) {
+    PyObject* v = PyLong_FromLong(vec[i]);
+    if(v == NULL) {
+      Py_DECREF(ret);
+      return NULL;
+    }
+    PyList_SET_ITEM(ret, i, v);
+  }
+  return ret;
+}
+
+PyObject*
+pyGetAlignments(PyObject* /*self*/, PyObject* args)
+{
+  PyObject *pleft, *pchoff, *pch, *paloff, *pal;
+  Py_ssize_t maxSegments = 0;
+  if(!PyArg_ParseTuple(args, "OOOOO|n:getAlignments",
+                       &pleft, &pchoff, &pch, &paloff, &pal, &maxSegments)) {
+    return NULL;
+  }
+  if(maxSegments < 0) {
+    PyErr_SetString(PyExc_ValueError, "max_segments must not be negative");
+    return NULL;
+  }
+  std::vector<int> left, choff, ch, aloff, al;
+  if(!readInts(pleft, "left must be a sequence", left) ||
+     !readInts(pchoff, "child_offsets must be a sequence", choff) ||
+     !readInts(pch, "children must be a sequence", ch) ||
+     !readInts(paloff, "align_offsets must be a sequence", aloff) ||
+     !readInts(pal, "align must be a sequence", al)) {
+    return NULL;
+  }
+  size_t count = left.size();
+  if(!checkOffsets(choff, count, ch.size(), "child_offsets") ||
+     !checkOffsets(aloff, count, al.size(), "align_offsets")) {
+    return NULL;
+  }
+  for(auto it : ch) {
+    if(it < 0 || (size_t)it >= count) {
+      PyErr_SetString(PyExc_ValueError, "child index out of range");
+      return NULL;
+    }
+  }
+  for(auto it : al) {
+    if(it < 0 || (size_t)it >= count) {
+      PyErr_SetString(PyExc_ValueError, "align index out of range");
+      return NULL;
+    }
+  }
+
+  Tree nodes(count, NULL);
+  for(size_t i = 0; i < count; i++) {
+    Node* n = new Node;
+    n->id = i;
+    n->parent = -1;
+    n->isVirtual = false;
+    n->isLeft = left[i];
+    n->children.assign(ch.begin()+choff[i], ch.begin()+choff[i+1]);
+    n->align.insert(al.begin()+aloff[i], al.begin()+aloff[i+1]);
+    nodes[i] = n;
+  }
+  attachParents(nodes);
+
+  Py_BEGIN_ALLOW_THREADS
+  getAlignments(nodes, maxSegments);
+  Py_END_ALLOW_THREADS
+
+  left.clear();
+  ch.clear();
+  al.clear();
+  choff.assign(1, 0);
+  aloff.assign(1, 0);
+  for(auto n : nodes) {
+    left.push_back(n->isLeft);
+    ch.insert(ch.end(), n->children.begin(), n->children.end());
+    choff.push_back(ch.size());
+    al.insert(al.end(), n->align.begin(), n->align.end());
+    aloff.push_back(al.size());
+    delete n;
+  }
+  return Py_BuildValue("(NNNNN)", toList(left), toList(choff), toList(ch),
+                       toList(aloff), toList(al));
+}
+
+static PyMethodDef methods[] = {
+  {"getAlignments", pyGetAlignments, METH_VARARGS,
+   "getAlignments(left, child_offsets, children, align_offsets, align, max_segments=0)\n"
+   "align a pair of trees, inserting virtual nodes if necessary"},
+  {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef module = {
+  PyModuleDef_HEAD_INIT, "pyalign", NULL, -1, methods,
+  NULL, NULL, NULL, NULL
+};
+
+PyMODINIT_FUNC
+PyInit_pyalign(void)
+{
+  return PyModule_Create(&module);
+}
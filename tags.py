@@ -1,35 +1,60 @@
 #!/usr/bin/python3
 
-import requests
 import html
 import json
 import os
-from typing import List
+from typing import List, Dict, Optional
 
 TAG_DATA_FILE = os.path.split(os.path.abspath(__file__))[0] + '/tags.json'
+# flat tables compiled from TAG_DATA_FILE, which are much quicker to load
+TAG_TABLE_FILE = os.path.split(os.path.abspath(__file__))[0] + '/tags.tsv'
+# increment when the format of TAG_TABLE_FILE changes
+TAG_TABLE_VERSION = 1
 
 category_to_tag = {}
 tag_to_category = {}
+# the values of each attribute, as load_attributes() returns them
+attribute_values: Dict[str, List[str]] = {}
+# lookups can happen in other threads while these are loaded, so they are
+# only ever replaced with complete new tables, never filled in place
 
-def flip_tags(dct, key=''):
-    '''generate tag_to_category from category_to_tag
-    called by scrape_tags() and load_tags(), do not call directly'''
-    global tag_to_category
+def flip_tags(dct, key, tags):
+    '''generate tag_to_category from category_to_tag into tags
+    called by compile_tags(), do not call directly'''
     for k in dct:
         if isinstance(dct[k], str):
-            tag_to_category[k] = key
+            tags[k] = key
+        else:
+            flip_tags(dct[k], k, tags)
+
+def collect_attributes(dct, key, attrs):
+    '''generate attribute_values from category_to_tag
+    called by compile_tags(), do not call directly'''
+    ls = []
+    for tag in dct:
+        if isinstance(dct[tag], str):
+            ls.append(tag)
         else:
-            flip_tags(dct[k], k)
+            collect_attributes(dct[tag], tag, attrs)
+    if ls:
+        attrs.setdefault(key, []).extend(ls)
 
-def scrape_tags():
-    '''scrape tag database from Apertium wiki'''
+def scrape_tags(wiki_file: Optional[str] = None):
+    '''scrape tag database from Apertium wiki
+    or from wiki_file, a saved copy of the raw text of the page'''
     global category_to_tag
     current = []
     all_tags = {}
-    r = requests.get('http://wiki.apertium.org/w/index.php?title=List_of_symbols&action=raw')
-    if r.status_code != 200:
-        raise Exception('Couldn\'t get wiki page')
-    for line in html.unescape(r.content.decode('utf-8')).splitlines():
+    if wiki_file:
+        with open(wiki_file) as f:
+            text = f.read()
+    else:
+        import requests
+        r = requests.get('http://wiki.apertium.org/w/index.php?title=List_of_symbols&action=raw')
+        if r.status_code != 200:
+            raise Exception('Couldn\'t get wiki page')
+        text = r.content.decode('utf-8')
+    for line in html.unescape(text).splitlines():
         #print(line)
         if line.startswith('==') and '<!--' in line:
             name = line.split('<!--')[1].split('-->')[0].strip()
@@ -58,17 +83,62 @@ def scrape_tags():
     with open(TAG_DATA_FILE, 'w') as f:
         json.dump(all_tags, f)
     category_to_tag = all_tags
-    flip_tags(all_tags)
+    compile_tags()
+
+def compile_tags():
+    '''fill in the lookup tables from category_to_tag and save them to TAG_TABLE_FILE'''
+    global attribute_values, tag_to_category
+    tags = {}
+    flip_tags(category_to_tag, '', tags)
+    attrs = {}
+    collect_attributes(category_to_tag, '', attrs)
+    tag_to_category = tags
+    attribute_values = attrs
+    try:
+        with open(TAG_TABLE_FILE, 'w') as f:
+            f.write('version\t%s\n' % TAG_TABLE_VERSION)
+            for name, values in attrs.items():
+                f.write('\t'.join(['attr', name] + values) + '\n')
+            for tag, cat in tags.items():
+                f.write('tag\t%s\t%s\n' % (tag, cat))
+    except OSError:
+        # e.g. a read-only install; the tables just get rebuilt next time
+        pass
+
+def load_tag_table() -> bool:
+    '''load the lookup tables from TAG_TABLE_FILE
+    returns False if it's missing or older than TAG_DATA_FILE or the current format'''
+    global attribute_values, tag_to_category
+    if not os.path.exists(TAG_TABLE_FILE):
+        return False
+    if os.path.exists(TAG_DATA_FILE) and os.path.getmtime(TAG_DATA_FILE) > os.path.getmtime(TAG_TABLE_FILE):
+        return False
+    with open(TAG_TABLE_FILE) as f:
+        if f.readline() != 'version\t%s\n' % TAG_TABLE_VERSION:
+            return False
+        attrs = {}
+        tags = {}
+        for line in f:
+            ls = line.rstrip('\n').split('\t')
+            if ls[0] == 'attr':
+                attrs[ls[1]] = ls[2:]
+            else:
+                tags[ls[1]] = ls[2]
+    tag_to_category = tags
+    attribute_values = attrs
+    return True
 
 def load_tags():
     '''load tag database from file'''
     global category_to_tag
-    with open(TAG_DATA_FILE) as f:
-        try:
+    if load_tag_table():
+        return
+    try:
+        with open(TAG_DATA_FILE) as f:
             category_to_tag = json.load(f)
-        except:
-            raise Exception("Tag data file missing or invalid. Please (re)run %s and try again." % os.path.abspath(__file__))
-    flip_tags(category_to_tag)
+    except (OSError, ValueError):
+        raise Exception("Tag data file missing or invalid. Please (re)run %s and try again." % os.path.abspath(__file__))
+    compile_tags()
 
 def lookup_tag(tag):
     global tag_to_category
@@ -77,34 +147,21 @@ def lookup_tag(tag):
     return tag_to_category.get(tag)
 
 class Attribute:
-    all_attrs = {}
     def __init__(self, name: str, values: List[str]):
         self.name = name
         self.values = values
-        Attribute.all_attrs[name] = self
     def __str__(self):
         return '%s = %s;' % (self.name, ' '.join(self.values))
-    def lookup(tag: str):
-        if len(Attribute.all_attrs) == 0:
-            Attribute.load_all()
-        return Attribute.all_attrs.get(lookup_tag(tag))
-    def load_all():
-        global category_to_tag
-        if len(category_to_tag) == 0:
-            load_tags()
-        def iter_tags(dct, key):
-            ls = []
-            for tag in dct:
-                if isinstance(dct[tag], str):
-                    ls.append(tag)
-                else:
-                    iter_tags(dct[tag], tag)
-            if ls:
-                if key in Attribute.all_attrs:
-                    Attribute.all_attrs[key].values += ls
-                else:
-                    Attribute(key, ls)
-        iter_tags(category_to_tag, '')
+
+def load_attributes() -> Dict[str, Attribute]:
+    '''a new Attribute for each category in the tag database'''
+    if len(attribute_values) == 0:
+        load_tags()
+    return {name: Attribute(name, list(values)) for name, values in attribute_values.items()}
 
 if __name__ == '__main__':
-    scrape_tags()
+    import argparse
+    parser = argparse.ArgumentParser(description='build the tag database from the List of symbols page on the Apertium wiki')
+    parser.add_argument('wiki_file', nargs='?', help='saved copy of the raw text of the page, rather than downloading it')
+    args = parser.parse_args()
+    scrape_tags(args.wiki_file)
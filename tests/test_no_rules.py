@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from no_rules import applicable
+from objects import Corpus, Grammar, Rule, Sentence, parse_tree
+
+class ApplicableTest(unittest.TestCase):
+    def setUp(self):
+        self.grammar = Grammar()
+        self.grammar.add_rule(Rule('NP', ['det', 'n']))
+        self.grammar.add_rule(Rule('ADJP', ['n', 'adj']))
+        # the current tree took n adj rather than det n
+        sl = parse_tree('^root{ ^a<det>/a<det>$ ^ADJP<ADJP>{ ^b<n>/b<n>$ ^c<adj>/c<adj>$ }$ }$')
+        self.corp = Corpus([Sentence(sl, sl)], grammar=self.grammar)
+
+    def test_span_not_in_tree(self):
+        # only fires over NP, which the grammar can build over a b
+        # but the current tree doesn't have
+        rl = self.grammar.add_rule(Rule('S', ['NP', 'adj']))
+        self.assertEqual(applicable(self.corp, [rl]), self.corp.sens)
+
+    def test_nested_span(self):
+        # NPA can only be built on top of NP
+        self.grammar.add_rule(Rule('NPA', ['NP', 'adj']))
+        rl = self.grammar.add_rule(Rule('S', ['NPA']))
+        self.assertEqual(applicable(self.corp, [rl]), self.corp.sens)
+
+    def test_words(self):
+        rl = self.grammar.add_rule(Rule('S', ['det', 'n', 'adj']))
+        self.assertEqual(applicable(self.corp, [rl]), self.corp.sens)
+
+    def test_no_match(self):
+        rl = self.grammar.add_rule(Rule('S', ['adj', 'NP']))
+        self.assertEqual(applicable(self.corp, [rl]), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+from typing import Dict, List, Hashable
+
+class Vocab:
+    '''interned symbol table assigning dense integer ids to words'''
+    def __init__(self):
+        self.ids: Dict[Hashable, int] = {}
+        self.words: List[Hashable] = []
+    def __len__(self):
+        return len(self.words)
+    def __getitem__(self, i: int) -> Hashable:
+        return self.words[i]
+    def intern(self, word: Hashable) -> int:
+        '''the id of word, assigning it the next one if it doesn't have one'''
+        i = self.ids.get(word)
+        if i is None:
+            i = len(self.words)
+            self.ids[word] = i
+            self.words.append(word)
+        return i
+    def get(self, word: Hashable) -> int:
+        '''the id of word, or -1 if it hasn't been interned'''
+        return self.ids.get(word, -1)